@@ -20,4 +20,8 @@ class FileTooLarge(ValueError):
     # 文件过大
     pass
 
+class LeaseLost(Exception):
+    # 任务租约已被其他工作进程领取
+    pass
+
 #todo 可以添加一个容量不足报错
\ No newline at end of file
@@ -1,10 +1,12 @@
 # 使用7z官方的二进制文件
-import concurrent.futures
 import os
+import posixpath
 import shutil
 import subprocess
 import re
-from typing import List, Dict
+import tempfile
+import time
+from typing import Callable, List, Dict, Iterable, Iterator, Optional, Tuple
 
 from Exception import PackError, NoRightPasswd, UnpackError, NoExistDecompressDir
 
@@ -18,17 +20,17 @@ class FileProcess:
         # 自动删除中间文件
         self.autodelete = autodelete
 
-    # noinspection PyDefaultArgument
-    def decompress(self, src_fs, dst_fs, passwords: list = [], max_workers=8):
+    def decompress(self, src_fs, dst_fs, passwords: list = None, mmt: int = None, info: Dict = None):
         """
-        解压文件到指定路径
+        解压文件到指定路径，先用压缩包头或单个最小的加密条目确定密码，再只解压一次
         :param passwords: 可用的密码列表
-        :param src_fs: 目标压缩文件所在文件夹
+        :param src_fs: 目标压缩文件（分卷则为第一卷）
         :param dst_fs: 解压工作路径 例如 "./tmp"
-        :param max_workers: 最大线程数量
-        :return: 解压后文件所在路径
+        :param mmt: 本次7z使用的线程数，默认为self.mmt
+        :param info: 已有的probe结果，为None则重新读取
+        :return: (解压后文件所在路径, 使用的密码)
         """
-        passwords.append(None)
+        candidates = list(passwords or [])
         if not os.path.exists(src_fs):
             raise NoExistDecompressDir(f"错误：源文件夹 {src_fs} 不存在")
         os.makedirs(dst_fs, exist_ok=True)
@@ -39,32 +41,280 @@ class FileProcess:
             src_fs,
             f'-o{dst_fs}',
             '-aoa',  # 覆盖文件
-            f'-mmt={self.mmt}'
+            f'-mmt={mmt or self.mmt}'
         ]
         if self.autodelete:
             origin_command.append('-sdel')
 
-        def try_decompress(pwd):
+        info = info if info is not None else self.probe(src_fs, candidates)
+        # 无法读取压缩包头时逐个密码尝试解压，不再并行以免互相覆盖
+        attempts = [None] + candidates
+        if info is not None:
+            # 先用低成本确定的密码，解压仍提示密码错误时继续尝试其余密码
+            found = self.find_password(src_fs, candidates, info)
+            attempts = [found] + [pwd for pwd in attempts if pwd != found]
+
+        for pwd in attempts:
             command = origin_command + ([f'-p{pwd}'] if pwd else ['-p'])
             result = subprocess.run(command, capture_output=True, text=True)
-            return result, pwd
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_pwd = {executor.submit(try_decompress, pwd): pwd for pwd in passwords}
-            for future in concurrent.futures.as_completed(future_to_pwd):
-                result, pwd = future.result()
-                if result.returncode == 0:
-                    executor.shutdown(wait=False, cancel_futures=True)
-                    return dst_fs
-                elif "Wrong password" in result.stderr:
+            if result.returncode == 0:
+                return dst_fs, pwd
+            elif "Wrong password" in result.stderr:
+                continue
+            else:
+                raise UnpackError(f"{src_fs}解压过程中发生错误: {result.stderr}\n标准输出: {result.stdout}")
+
+        raise NoRightPasswd(f"{src_fs}没有正确的密码")
+
+    def find_password(self, archive: str, passwords: list, info: Dict) -> Optional[str]:
+        """
+        低成本确定正确的密码：头部加密的压缩包在读取列表时已确定，否则只测试最小的一个加密条目
+        :param archive: 压缩包（分卷则为第一卷）路径
+        :param passwords: 可用的密码列表
+        :param info: probe的返回值
+        :return: 正确的密码，无需密码则为None
+        """
+        # 没有数据的加密条目（RAR4、ZipCrypto）用任何密码测试都能通过，不能用来确定密码
+        encrypted = [entry for entry in info['entries'] if entry.get('Encrypted') == '+' and int(entry.get('Size') or 0) > 0]
+        if not encrypted or info['password'] is not None:
+            return info['password']
+        smallest = min(encrypted, key=lambda entry: int(entry.get('Size') or 0))
+        for pwd in passwords:
+            # -spd 关闭通配符匹配，只测试这一个条目
+            command = [self.p7zip_file, 't', archive, f'-p{pwd}', '-spd', smallest['Path']]
+            result = subprocess.run(command, capture_output=True, text=True)
+            if result.returncode == 0:
+                return pwd
+            elif "Wrong password" in result.stderr:
+                continue
+            else:
+                raise UnpackError(f"{archive}测试密码时发生错误: {result.stderr}\n标准输出: {result.stdout}")
+        raise NoRightPasswd(f"{archive}没有正确的密码")
+
+    @staticmethod
+    def _parse_slt(stdout: str) -> List[Dict[str, str]]:
+        """
+        解析 7z l -slt 的输出
+        :return: 每个条目的属性字典，例如 {'Path': 'a.txt', 'Size': '10', 'Folder': '-'}
+        """
+        body = re.split(r'\r?\n----------\r?\n', stdout, maxsplit=1)
+        if len(body) < 2:
+            return []
+        entries, current = [], {}
+        for line in body[1].splitlines():
+            line = line.strip()
+            if not line:
+                if current:
+                    entries.append(current)
+                    current = {}
+                continue
+            key, sep, value = line.partition(' = ')
+            if sep:
+                current[key] = value
+        if current:
+            entries.append(current)
+        return entries
+
+    def probe(self, archive: str, passwords: list = None) -> Optional[Dict]:
+        """
+        读取压缩包头获取解压后的真实大小和文件数量，头部加密的压缩包会依次尝试密码
+        :param archive: 压缩包（分卷则为第一卷）路径
+        :param passwords: 可用的密码列表
+        :return: {'size': 解压后大小, 'files': 文件数量, 'password': 能读取头部的密码, 'entries': 条目列表}，无法读取则为None
+        """
+        for pwd in [None] + list(passwords or []):
+            command = [self.p7zip_file, 'l', '-slt', archive, f'-p{pwd}' if pwd else '-p']
+            result = subprocess.run(command, capture_output=True, text=True)
+            if result.returncode != 0:
+                # 头部加密且密码错误时继续尝试下一个密码
+                if "Wrong password" in result.stderr or "Can not open encrypted archive" in result.stderr:
                     continue
+                return None
+            entries = [entry for entry in self._parse_slt(result.stdout) if entry.get('Folder') != '+']
+            return {
+                'size': sum(int(entry.get('Size') or 0) for entry in entries),
+                'files': len(entries),
+                'password': pwd,
+                'entries': entries,
+            }
+        return None
+
+    def probe_partial(self, directory: str, volumes: List[str], passwords: list = None) -> Optional[Dict]:
+        """
+        只下载了第一卷和最后一卷时读取按字节切分的分卷组的压缩包头
+        7z和zip的头部位于第一卷开头和最后一卷末尾，中间的分卷用与第一卷同样大小的稀疏文件占位，不占用磁盘空间
+        :param directory: 分卷所在目录
+        :param volumes: 按序号排序的分卷文件名
+        :param passwords: 可用的密码列表
+        :return: 同probe
+        """
+        volume_size = os.path.getsize(os.path.join(directory, volumes[0]))
+        with tempfile.TemporaryDirectory(dir=directory) as probe_dir:
+            for volume in volumes:
+                target = os.path.join(probe_dir, volume)
+                if volume in (volumes[0], volumes[-1]):
+                    os.symlink(os.path.abspath(os.path.join(directory, volume)), target)
                 else:
-                    executor.shutdown(wait=False, cancel_futures=True)
-                    raise UnpackError(f"{src_fs}解压过程中发生错误: {result.stderr}\n标准输出: {result.stdout}")
+                    with open(target, 'wb') as placeholder:
+                        placeholder.truncate(volume_size)
+            return self.probe(os.path.join(probe_dir, volumes[0]), passwords)
 
-        raise NoRightPasswd(f"{src_fs}没有正确的密码")
+    def probe_sparse(self, directory: str, volumes: List[Tuple[str, int]], head: bytes, tail: bytes,
+                     passwords: list = None) -> Optional[Dict]:
+        """
+        只用远端读取的开头和末尾内容读取压缩包头，其余部分用稀疏文件占位，不占用磁盘空间
+        7z的起始头位于开头，目录位于末尾，末尾内容不足以包含目录时7z校验失败，返回None
+        :param directory: 临时目录所在路径
+        :param volumes: 按序号排序的 (分卷文件名, 大小)
+        :param head: 第一卷开头的内容
+        :param tail: 最后一卷末尾的内容
+        :param passwords: 可用的密码列表
+        :return: 同probe
+        """
+        with tempfile.TemporaryDirectory(dir=directory) as probe_dir:
+            for index, (volume, size) in enumerate(volumes):
+                with open(os.path.join(probe_dir, volume), 'wb') as placeholder:
+                    placeholder.truncate(size)
+                    if index == 0:
+                        placeholder.write(head)
+                    if index == len(volumes) - 1:
+                        placeholder.seek(size - len(tail))
+                        placeholder.write(tail)
+            return self.probe(os.path.join(probe_dir, volumes[0][0]), passwords)
+
+    # 7z格式的文件头签名
+    signature_7z = b"7z\xbc\xaf\x27\x1c"
+
+    @staticmethod
+    def volume_bytes(volumes: str) -> Optional[int]:
+        """
+        :param volumes: 7z的分卷大小参数，例如 4G、500m、1024k
+        :return: 字节数，不分卷则为None
+        """
+        match = re.fullmatch(r'(\d+)([bkmg]?)', (volumes or '').strip().lower())
+        if not match:
+            return None
+        return int(match.group(1)) * {'': 1, 'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}[match.group(2)]
+
+    @staticmethod
+    def target_names(names: List[str], volume_size: Optional[int]) -> bool:
+        """
+        只按文件名判断是否可能符合压缩阶段的输出，不需要读取远端
+        :param names: 按序号排序的分卷文件名
+        :param volume_size: 目标分卷大小，不分卷则为None
+        """
+        if len(names) == 1:
+            return names[0].lower().endswith('.7z')
+        return volume_size is not None and all(re.search(r'\.7z\.\d{3}$', name, re.IGNORECASE) for name in names)
+
+    @classmethod
+    def target_layout(cls, volumes: List[Tuple[str, int]], volume_size: Optional[int]) -> bool:
+        """
+        判断文件名和大小是否已符合压缩阶段的输出：7z格式，除最后一卷外都等于分卷大小
+        :param volumes: 按序号排序的 (分卷文件名, 大小)
+        :param volume_size: 目标分卷大小，不分卷则为None
+        """
+        if not cls.target_names([name for name, _ in volumes], volume_size):
+            return False
+        if len(volumes) == 1:
+            return volume_size is None or volumes[0][1] <= volume_size
+        return all(size == volume_size for _, size in volumes[:-1]) and 0 < volumes[-1][1] <= volume_size
+
+    # 发布者标签，例如 [Group]xxx.rar、【Group】xxx.rar
+    uploader_pattern = re.compile(r'^\s*[\[【(（]([^\]】)）]+)[\]】)）]')
+
+    @classmethod
+    def password_key(cls, path: str) -> Tuple[str, str]:
+        """
+        密码统计的分类键
+        :param path: 压缩包（第一卷）的完整路径
+        :return: (所在目录, 发布者标签)，没有标签则为空字符串
+        """
+        directory, sep, name = path.replace('\\', '/').rpartition('/')
+        if not sep:
+            # 位于远端根目录，例如 Alist:b.rar
+            directory, sep, name = path.rpartition(':')
+            directory += sep
+        match = cls.uploader_pattern.match(name)
+        return directory, match.group(1).strip().lower() if match else ''
+
+    # 分卷序号的匹配模式，例如 .part01.rar、.7z.001、.001.exe
+    volume_pattern = re.compile(r'\.(?:part(\d+)\.(?:rar|exe)|(?:7z|zip)\.(\d{3})|(\d{3})\.exe)$', re.IGNORECASE)
+
+    # 按字节切分的分卷，例如 .7z.001、.zip.001，各卷直接拼接即为完整的压缩包
+    split_pattern = re.compile(r'\.(?:7z|zip)\.(\d{3})$', re.IGNORECASE)
+
+    @classmethod
+    def split_volumes(cls, paths: List[str]) -> Optional[List[str]]:
+        """
+        :param paths: 同一组分卷的路径
+        :return: 按序号排序的分卷，不是按字节切分的分卷组则为None
+        """
+        matches = [(cls.split_pattern.search(path), path) for path in paths]
+        if len(paths) < 2 or not all(match for match, _ in matches) or len(cls.volume_sets(paths)) != 1:
+            return None
+        return [path for _, path in sorted(matches, key=lambda item: int(item[0].group(1)))]
+
+    @classmethod
+    def first_volume(cls, paths: List[str]) -> str:
+        """
+        :param paths: 同一组分卷的路径
+        :return: 序号最小的分卷，7z需要从第一卷开始读取
+        """
+        def volume_index(path):
+            match = cls.volume_pattern.search(path)
+            index = next((int(group) for group in match.groups() if group), 0) if match else 0
+            return index, path
+        return min(paths, key=volume_index)
+
+    def transcode(self, archive: str, dst_fs: str, name: str, entry: str, pwd: str = None, password: str = None,
+                  mx: int = 0, volumes: str = "4G", mmt: int = None):
+        """
+        只有单个文件的压缩包通过管道 7z x -so | 7z a -si 直接重新压缩，解压结果不落地
+        :param archive: 源压缩包（分卷则为第一卷）
+        :param dst_fs: 压缩文件输出路径
+        :param name: 输出压缩包名称，与compress一致为 name.7z，包内路径为 name/entry
+        :param entry: 源压缩包内唯一文件的路径
+        :param pwd: 源压缩包密码
+        :param password: 压缩密码，默认为空
+        :param mx: 压缩率，默认为0，范围0-10
+        :param volumes: 分卷大小，默认为4g
+        :param mmt: 本次7z使用的线程数，默认为self.mmt
+        :return: 压缩包所在路径
+        """
+        os.makedirs(dst_fs, exist_ok=True)
+        dst_location = os.path.join(dst_fs, f"{name}.7z")
+        extract_command = [self.p7zip_file, 'x', archive, '-so', '-spd', f'-p{pwd}' if pwd else '-p', entry]
+        pack_command = [self.p7zip_file, 'a', '-y', '-mx' + str(mx).lower(), f'-mmt={mmt or self.mmt}',
+                        f'-si{name}/{entry}']
+        if password:
+            pack_command.append(f'-p{password}')
+        if volumes:
+            pack_command.append(f'-v{volumes}')
+        pack_command.append(dst_location)
+
+        extractor = subprocess.Popen(extract_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        packer = subprocess.Popen(pack_command, stdin=extractor.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # 关闭父进程持有的管道，压缩进程退出时解压进程能收到SIGPIPE
+        extractor.stdout.close()
+        _, pack_stderr = packer.communicate()
+        extract_stderr = extractor.stderr.read().decode(errors='replace')
+        extractor.stderr.close()
+        extractor.wait()
+
+        if extractor.returncode != 0 or packer.returncode != 0:
+            shutil.rmtree(dst_fs, ignore_errors=True)
+            if "Wrong password" in extract_stderr:
+                raise NoRightPasswd(f"{archive}没有正确的密码")
+            if extractor.returncode != 0:
+                raise UnpackError(f"{archive}流式解压过程中发生错误: {extract_stderr}")
+            raise PackError(f"{archive}流式压缩过程中发生错误: {pack_stderr.decode(errors='replace')}")
+        if self.autodelete:
+            os.remove(archive)
+        return dst_fs
 
-    def compress(self, src_fs: str, dst_fs: str, password: str = None,mx:int=0,volumes: str = "4G"):
+    def compress(self, src_fs: str, dst_fs: str, password: str = None,mx:int=0,volumes: str = "4G", mmt: int = None,
+                 on_volume: Callable[[str], None] = None, poll_interval: float = 1):
         """
         压缩文件或目录
         :param src_fs: 目标文件夹
@@ -72,10 +322,13 @@ class FileProcess:
         :param mx: 压缩率，默认为0，范围0-10
         :param password: 压缩密码，默认为空
         :param volumes: 分卷大小，默认为4g
+        :param mmt: 本次7z使用的线程数，默认为self.mmt
+        :param on_volume: 分卷写完后的回调，参数为分卷路径，为None则等待整个压缩包完成
+        :param poll_interval: 检查分卷的间隔时间（秒）
         :return: 压缩包文件名称
         """
 
-        command = [self.p7zip_file, 'a','-y','-mx' + str(mx).lower(),f'-mmt={self.mmt}']  # 基本命令：添加到压缩包，仅储存，压缩后删除源文件
+        command = [self.p7zip_file, 'a','-y','-mx' + str(mx).lower(),f'-mmt={mmt or self.mmt}']  # 基本命令：添加到压缩包，仅储存，压缩后删除源文件
         if self.autodelete:
             command.append('-sdel')
         # 获取文件名
@@ -92,6 +345,8 @@ class FileProcess:
 
         # 添加输出路径和需要压缩的源路径
         command.extend([dst_location, src_fs])
+        if on_volume is not None and volumes:
+            return self._compress_volumes(command, src_fs, dst_fs, dst_location, on_volume, poll_interval)
         # self.logging.debug(f"当前压缩命令 {command}")
         # 执行命令
         result = subprocess.run(command, capture_output=True, text=True)
@@ -102,6 +357,181 @@ class FileProcess:
         else:
             raise PackError(f"{src_fs}压缩过程中发生错误: {result.stderr}")
 
+    def _compress_volumes(self, command: List[str], src_fs: str, dst_fs: str, dst_location: str,
+                          on_volume: Callable[[str], None], poll_interval: float):
+        """
+        后台运行压缩命令，出现下一个分卷即说明上一个分卷已写完，立即交给on_volume
+        7z结束时会回写第一卷中的起始头，第一卷和最后一卷留在dst_fs中由调用方处理
+        """
+        volume_pattern = re.compile(re.escape(os.path.basename(dst_location)) + r'\.(\d{3})$')
+        reported = set()
+
+        def closed_volumes():
+            indexes = sorted(
+                int(match.group(1)) for match in map(volume_pattern.match, os.listdir(dst_fs)) if match
+            ) if os.path.isdir(dst_fs) else []
+            # 编号最大的分卷可能仍在写入
+            return [index for index in indexes[:-1] if index > 1 and index not in reported]
+
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=stderr)
+            try:
+                while process.poll() is None:
+                    for index in closed_volumes():
+                        reported.add(index)
+                        on_volume(f"{dst_location}.{index:03d}")
+                    time.sleep(poll_interval)
+            except BaseException:
+                process.kill()
+                process.wait()
+                raise
+            if process.returncode != 0:
+                stderr.seek(0)
+                raise PackError(f"{src_fs}压缩过程中发生错误: {stderr.read().decode(errors='replace')}")
+        return dst_fs
+
+    # 定义压缩类型及其匹配模式的正则表达式
+    patterns = {
+        'rar': re.compile(r'^(?P<base>.+?)(?:\.part\d+)?\.rar$', re.IGNORECASE),
+        '7z': re.compile(r'^(?P<base>.+?)\.7z(?:\.\d{3})?$', re.IGNORECASE),
+        'zip': re.compile(r'^(?P<base>.+?)\.zip(?:\.\d{3})?$', re.IGNORECASE),
+        # 仅匹配包含分卷标识的自解压压缩包，如 'filename.part01.exe' 或 'filename.001.exe'
+        'sfx': re.compile(r'^(?P<base>.+?)\.(?:part\d+|\d{3})\.exe$', re.IGNORECASE)
+    }
+
+    @staticmethod
+    def full_path(fs: str, path: str) -> str:
+        """
+        拼接驱动器和相对路径，防止Windows路径问题
+        :param fs: 驱动器，例如 Alist:
+        :param path: 相对驱动器根目录的路径
+        """
+        return os.path.join(fs, path.replace('\\', '/')).replace('\\', '/')
+
+    @classmethod
+    def _match_file(cls, file: Dict, fs: str = None, depth: int = 0) -> Optional[Tuple[str, str, int]]:
+        """
+        匹配单个文件所属的压缩包分组
+        :param file: 文件信息，包含 'Name'、'Path'、'Size'
+        :param fs: 添加到文件名前的附加路径，例如 Alist:
+        :param depth: 使用路径中的目录作为基础文件名的深度。0 表示使用去掉分卷标识和扩展名的文件名。
+        :return: (分组名, 完整路径, 大小)，不属于任何压缩类型则返回None
+        """
+        base_name = file.get('Name', '')
+        path = file.get('Path', '').replace('\\', '/')
+        size = file.get('Size', 0)
+
+        for file_type, pattern in cls.patterns.items():
+            match = pattern.match(base_name)
+            if match:
+                # 匹配成功后不再继续检测其他类型
+                break
+        else:
+            # 文件不属于定义的任何压缩类型或 SFX，忽略
+            return None
+
+        if depth == 0:
+            # 使用去掉分卷标识和扩展名的文件名，同一组分卷归入同一个任务
+            output_name = match.group('base')
+        else:
+            path_parts = path.split('/')
+            if len(path_parts) >= depth or depth < 0:
+                output_name = path_parts[depth-1]
+            else:
+                output_name = match.group('base')  # 如果深度超出路径长度，使用文件名
+        return output_name, cls.full_path(fs, path), size
+
+    @staticmethod
+    def _add_to_group(categorized: Dict[str, Dict], output_name: str, path: str, size: int):
+        if output_name not in categorized:
+            categorized[output_name] = {'paths': set(), 'total_size': 0, 'sizes': {}}
+        if path not in categorized[output_name]['paths']:
+            categorized[output_name]['paths'].add(path)
+            categorized[output_name]['total_size'] += size
+            categorized[output_name]['sizes'][path] = size
+
+    @staticmethod
+    def _merge_groups(categorized: Dict[str, Dict], groups: Dict[str, Dict]):
+        # 合并同名分组（depth为0时不同目录下可能存在同名文件，列表中的路径不会重复）
+        for name, group in groups.items():
+            if name not in categorized:
+                categorized[name] = group
+                continue
+            categorized[name]['paths'] |= group['paths']
+            categorized[name]['total_size'] += group['total_size']
+            categorized[name]['sizes'].update(group['sizes'])
+
+    @classmethod
+    def _finish_groups(cls, categorized: Dict[str, Dict]) -> Dict[str, Dict]:
+        # 将路径集合转换为有序列表，并检查分卷是否完整
+        for base in categorized:
+            categorized[base]['paths'] = sorted(categorized[base]['paths'])
+            categorized[base]['volumes'] = cls.check_volumes(sorted(categorized[base].pop('sizes').items()))
+        return categorized
+
+    @classmethod
+    def _volume_key(cls, path: str) -> Tuple[Tuple[str, str, Optional[str]], int]:
+        """
+        :param path: 完整路径
+        :return: ((所在目录, 名称, 分卷方式), 分卷序号)，单个压缩包的分卷方式为None、序号为0
+        """
+        name = posixpath.basename(path)
+        match = cls.volume_pattern.search(name)
+        if not match:
+            return (posixpath.dirname(path), name, None), 0
+        if match.group(1):
+            # .partN.rar 和 .partN.exe（自解压第一卷）属于同一组
+            scheme, index = 'part', int(match.group(1))
+        elif match.group(2):
+            scheme, index = name[match.start() + 1:].split('.')[0].lower(), int(match.group(2))
+        else:
+            scheme, index = 'exe', int(match.group(3))
+        return (posixpath.dirname(path), name[:match.start()], scheme), index
+
+    @classmethod
+    def volume_sets(cls, paths: List[str]) -> List[List[str]]:
+        """
+        depth不为0时一个分组可能包含多个独立的压缩包，按所在目录、名称和分卷方式拆分
+        :param paths: 分组中的全部路径
+        :return: 每个压缩包按序号排序的分卷路径，第一项即为解压时使用的第一卷
+        """
+        sets = {}
+        for path in paths:
+            key, index = cls._volume_key(path)
+            sets.setdefault(key, []).append((index, path))
+        return [[path for _, path in sorted(volumes)] for _, volumes in sorted(sets.items(), key=lambda item: item[0][:2])]
+
+    @classmethod
+    def check_volumes(cls, files: List[Tuple[str, int]]) -> Dict:
+        """
+        检查分组中的每组分卷是否完整：序号从1开始连续，中间分卷大小一致，最后一卷不大于中间分卷
+        depth不为0时一个分组可能包含多组分卷，按所在目录、名称和分卷方式分别检查
+        :param files: (完整路径, 大小) 列表
+        :return: {'complete': 是否完整, 'problem': 不完整的原因, 'sets': [{'name', 'scheme', 'parts', 'missing'}]}
+        """
+        sets = {}
+        for path, size in files:
+            key, index = cls._volume_key(path)
+            if key[2] is None:
+                # 单个压缩包
+                continue
+            sets.setdefault(key, {})[index] = size
+
+        result, problems = [], []
+        for (directory, name, scheme), parts in sorted(sets.items()):
+            indexes = sorted(parts)
+            missing = sorted(set(range(1, indexes[-1] + 1)) - set(indexes))
+            result.append({'name': name, 'scheme': scheme, 'parts': indexes, 'missing': missing})
+            if missing:
+                problems.append(f"{name}({scheme})缺少第{','.join(map(str, missing))}卷")
+                continue
+            # 自解压的第一卷包含自解压模块，不参与大小比较
+            body = [parts[index] for index in indexes[:-1] if not (scheme == 'part' and index == 1)]
+            last = parts[indexes[-1]]
+            if len(set(body)) > 1 or last <= 0 or (body and last > body[0]):
+                problems.append(f"{name}({scheme})分卷大小不一致")
+        return {'complete': not problems, 'problem': '；'.join(problems) or None, 'sets': result}
+
     def filter_files(self, file_list: List[Dict], fs: str = None, depth: int = 0) -> Dict[str, Dict]:
         """
         按基础文件名和路径分类文件，并计算这些文件的总大小。
@@ -109,59 +539,111 @@ class FileProcess:
         Args:
             file_list (List[Dict]): 包含文件信息的字典列表，每个字典包含 'Name' 和 'Path' 键。
             fs: 添加到文件名前的附加路径，例如 Alist:
-            depth: 使用路径中的目录作为基础文件名的深度。0 表示使用文件名。
+            depth: 使用路径中的目录作为基础文件名的深度。0 表示使用去掉分卷标识和扩展名的文件名。
 
         Returns:
             Dict[str, Dict]: 嵌套字典，第一层键为基础文件名，
-                             值为包含 'paths' 列表和 'total_size' 的字典。
+                             值为包含 'paths' 列表、'total_size' 和分卷检查结果 'volumes' 的字典。
         """
-        # 定义压缩类型及其匹配模式的正则表达式
-        patterns = {
-            'rar': re.compile(r'^(?P<base>.+?)(?:\.part\d+)?\.rar$', re.IGNORECASE),
-            '7z': re.compile(r'^(?P<base>.+?)\.7z(?:\.\d{3})?$', re.IGNORECASE),
-            'zip': re.compile(r'^(?P<base>.+?)\.zip(?:\.\d{3})?$', re.IGNORECASE),
-            # 仅匹配包含分卷标识的自解压压缩包，如 'filename.part01.exe' 或 'filename.001.exe'
-            'sfx': re.compile(r'^(?P<base>.+?)\.(?:part\d+|\d{3})\.exe$', re.IGNORECASE)
-        }
-
         categorized = {}
         if not file_list:
             raise ValueError("No File List To Filter")
 
         for file in file_list:
-            base_name = file.get('Name', '')
-            path = file.get('Path', '').replace('\\', '/')
-            size = file.get('Size', 0)
-            matched = False  # 标记文件是否已被匹配
+            matched = self._match_file(file, fs, depth)
+            if matched:
+                self._add_to_group(categorized, *matched)
 
-            if depth == 0:
-                output_name = base_name
-            else:
-                path_parts = path.split('/')
-                if len(path_parts) >= depth or depth < 0:
-                    output_name = path_parts[depth-1]
-                else:
-                    output_name = base_name  # 如果深度超出路径长度，使用文件名
-
-            for file_type, pattern in patterns.items():
-                match = pattern.match(base_name)
-                if match:
-                    if output_name not in categorized:
-                        categorized[output_name] = {'paths': set(), 'total_size': size}
-                    categorized[output_name]['paths'].add(os.path.join(fs, path).replace('\\', '/'))
-                    categorized[output_name]['total_size'] += size
-                    matched = True
-                    break  # 匹配成功后不再继续检测其他类型
+        return self._finish_groups(categorized)
+
+    def stream_filter_files(self, files: Iterable[Dict], fs: str = None, depth: int = 0,
+                            batch_size: int = 1000) -> Iterator[Dict[str, Dict]]:
+        """
+        filter_files的流式版本，边读取文件列表边分组，分批输出已完整的分组。
+
+        depth 为 0 时分组不跨目录，Rclone 列表中同一目录的文件是连续输出的，离开该目录即可输出其分组；
+        否则分组可能跨越多个目录，需等列表结束后统一输出。
+
+        Args:
+            files (Iterable[Dict]): 文件信息的迭代器，格式同 filter_files
+            fs: 添加到文件名前的附加路径，例如 Alist:
+            depth: 使用路径中的目录作为基础文件名的深度。0 表示使用去掉分卷标识和扩展名的文件名。
+            batch_size: 每批最多输出的分组数量
+
+        Yields:
+            Dict[str, Dict]: 与 filter_files 返回值格式相同的分组批次
+        """
+        pending = {}
+        ready = {}
+        current_dir = None
 
+        for file in files:
+            matched = self._match_file(file, fs, depth)
             if not matched:
-                # 文件不属于定义的任何压缩类型或 SFX，忽略或根据需要处理
-                pass
+                continue
+            output_name, path, size = matched
+            directory = posixpath.dirname(path)
+            if depth == 0 and directory != current_dir:
+                # 已离开上一个目录，其分组不会再有新的分卷
+                self._merge_groups(ready, pending)
+                pending = {}
+                current_dir = directory
+                if len(ready) >= batch_size:
+                    yield self._finish_groups(ready)
+                    ready = {}
+            self._add_to_group(pending, output_name, path, size)
 
-        # 将路径集合转换为列表，并计算每个基本文件名的总大小
-        for base in categorized:
-            categorized[base]['paths'] = sorted(categorized[base]['paths'])
+        self._merge_groups(ready, pending)
+        # 剩余分组按批次输出
+        names = list(ready)
+        for i in range(0, len(names), batch_size):
+            yield self._finish_groups({name: ready[name] for name in names[i:i + batch_size]})
 
-        return categorized
+    @staticmethod
+    def get_dir_size(fs):
+        """
+        :param fs: 本地文件夹路径
+        :return: 实际占用的磁盘空间（字节），不存在则为0
+        """
+        total = 0
+        for root, dirs, files in os.walk(fs):
+            for file in files:
+                try:
+                    stat = os.lstat(os.path.join(root, file))
+                except OSError:
+                    # 统计期间文件可能已被删除
+                    continue
+                # Windows没有st_blocks，使用文件大小
+                blocks = getattr(stat, 'st_blocks', None)
+                total += blocks * 512 if blocks is not None else stat.st_size
+        return total
+
+    @staticmethod
+    def check_extracted(fs: str, unpacked_size: Optional[int] = None, file_count: Optional[int] = None) -> bool:
+        """
+        检查解压目录是否完整
+        :param fs: 解压目录
+        :param unpacked_size: probe得到的解压后大小，为None时无法确认完整，视为不完整
+        :param file_count: probe得到的文件数量，为None时无法确认完整，视为不完整
+        """
+        if unpacked_size is None or file_count is None:
+            # 没有探测结果时只能重新解压（或重新下载）
+            return False
+        size, count = 0, 0
+        for root, dirs, files in os.walk(fs):
+            for file in files:
+                size += os.lstat(os.path.join(root, file)).st_size
+                count += 1
+        return size == unpacked_size and count == file_count
+
+    @staticmethod
+    def check_compressed(fs: str, name: str) -> bool:
+        """
+        检查压缩目录中是否有compress或transcode的输出（分卷则为第一卷，边压缩边上传时中间分卷可能已上传）
+        :param fs: 压缩目录
+        :param name: 压缩包名称
+        """
+        return any(os.path.isfile(os.path.join(fs, f"{name}.7z{suffix}")) for suffix in ('', '.001'))
 
     @staticmethod
     def get_free_size(fs):
@@ -1,29 +1,285 @@
 # main.py
 import argparse
 import concurrent.futures
+import hashlib
+import json
 import logging
 import os
-from queue import Queue, Empty
+from queue import Queue
 import shutil
+import socket
 import threading
 import time
-from concurrent.futures import Future
 from concurrent.futures.thread import ThreadPoolExecutor
 from contextlib import contextmanager
 from dataclasses import dataclass, field
-from typing import Callable, Any, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 from threading import Lock
 
 import psutil
 from dotenv import load_dotenv
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 
-from Exception import NoRightPasswd, UnpackError, PackError, RcloneError, NoExistDecompressDir, FileTooLarge
+from Exception import NoRightPasswd, UnpackError, PackError, RcloneError, NoExistDecompressDir, FileTooLarge, LeaseLost
 from fileprocess import FileProcess
-from rclone import OwnRclone, DataBase
+from rclone import Rclone, OwnRclone, DataBase
 from set_logger import setup_logger
 
 
+@dataclass
+class StageLimiter:
+    """
+    阶段并发闸门，上限可在运行时调整，线程池按最大值创建，实际并发由闸门控制
+    """
+    limit: int = field(init=True)
+    max_limit: int = field(init=True)
+    # 最近一次调整的原因
+    reason: str = field(default="初始值")
+
+    def __post_init__(self):
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def resize(self, limit: int, reason: str):
+        with self._condition:
+            self.limit = max(1, min(limit, self.max_limit))
+            self.reason = reason
+            self._condition.notify_all()
+
+    @property
+    def status(self):
+        with self._condition:
+            return {"limit": self.limit, "max_limit": self.max_limit, "active": self.active, "reason": self.reason}
+
+
+@dataclass
+class DiskLedger:
+    """
+    磁盘预留账本，按任务和阶段记录预留空间，并定期用临时目录的实际大小和磁盘剩余空间校正
+    """
+    tmp: str = field(init=True)
+    # 脚本允许使用的最大空间，为0则只受磁盘剩余空间限制
+    max_spaces: int = field(default=0)
+    # 预留10%容灾空间
+    ratio: float = field(default=0.9)
+
+    def __post_init__(self):
+        # (任务名, 阶段) -> 预留字节 / 实际占用字节
+        self._reserved: Dict[Tuple[str, str], int] = {}
+        self._actual: Dict[Tuple[str, str], int] = {}
+        self._condition = threading.Condition()
+        self.budget = 0
+        # 账本变化时的回调，例如唤醒调度器重新选择任务
+        self.listeners: List[Callable[[], None]] = []
+        self.refresh()
+
+    def _notify_listeners(self):
+        # 在释放账本锁之后调用，避免与调度器互相等待
+        for listener in self.listeners:
+            listener()
+
+    def _used(self) -> int:
+        # 每一项按预留和实际占用中较大者计算，实际超出预估时也不会超用磁盘
+        return sum(max(size, self._actual.get(key, 0)) for key, size in self._reserved.items())
+
+    def refresh(self):
+        """
+        测量各阶段目录的实际大小，并按磁盘剩余空间重新计算可用额度
+        """
+        with self._condition:
+            keys = list(self._reserved)
+        actual = {key: FileProcess.get_dir_size(os.path.join(self.tmp, key[1], key[0])) for key in keys}
+        free = FileProcess.get_free_size(self.tmp)
+        with self._condition:
+            self._actual = {key: size for key, size in actual.items() if key in self._reserved}
+            # 已写入磁盘的部分也属于可用容量
+            capacity = free + sum(self._actual.values())
+            if self.max_spaces:
+                capacity = min(capacity, self.max_spaces)
+            self.budget = int(capacity * self.ratio)
+            self._condition.notify_all()
+        self._notify_listeners()
+
+    def run(self, interval: float):
+        # 定期校正账本
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except OSError as e:
+                logging_capture.warning(f"磁盘账本校正失败: {e}")
+
+    def reserve(self, name: str, sizes: Dict[str, int]):
+        """
+        任务准入时一次性预留各阶段的空间，空间不足时阻塞等待其他任务释放
+        :param name: 任务名
+        :param sizes: {阶段: 预留字节}
+        """
+        total = int(sum(sizes.values()))
+        with self._condition:
+            if any(key[0] == name for key in self._reserved):
+                # 调度器已经为该任务预留
+                return
+            while True:
+                if total > self.budget:
+                    raise FileTooLarge(f"文件过大，需要{total}字节，可用额度{self.budget}字节")
+                if self._used() + total <= self.budget:
+                    break
+                logging_capture.info(f"任务{name}需要{total}字节，目前已预留{self._used()}，额度{self.budget}，等待释放空间")
+                self._condition.wait()
+            for stage, size in sizes.items():
+                self._reserved[(name, stage)] = int(size)
+
+    def try_reserve(self, name: str, sizes: Dict[str, int]) -> bool:
+        """
+        不阻塞地尝试预留
+        :return: 是否可以开始该任务；超过全部额度的任务直接返回True且不预留，由reserve报FileTooLarge
+        """
+        total = int(sum(sizes.values()))
+        with self._condition:
+            if total > self.budget:
+                return True
+            if self._used() + total > self.budget:
+                return False
+            for stage, size in sizes.items():
+                self._reserved[(name, stage)] = int(size)
+            return True
+
+    def restore(self, name: str, sizes: Dict[str, int]):
+        """
+        恢复重启前已在磁盘上的任务的预留，不检查额度，实际占用由refresh校正
+        :param name: 任务名
+        :param sizes: {阶段: 预留字节}
+        """
+        with self._condition:
+            for stage, size in sizes.items():
+                self._reserved[(name, stage)] = int(size)
+        self._notify_listeners()
+
+    @property
+    def headroom(self) -> int:
+        with self._condition:
+            return self.budget - self._used()
+
+    def adjust(self, name: str, sizes: Dict[str, int]):
+        """
+        用更准确的大小替换任务尚未释放的预留，不阻塞；超出额度时由后续任务的准入等待
+        :param name: 任务名
+        :param sizes: {阶段: 预留字节}
+        """
+        with self._condition:
+            for stage, size in sizes.items():
+                if (name, stage) in self._reserved:
+                    self._reserved[(name, stage)] = int(size)
+            self._condition.notify_all()
+        self._notify_listeners()
+
+    def release(self, name: str, stage: str = None):
+        """
+        释放预留空间，可重复调用
+        :param name: 任务名
+        :param stage: 阶段，为None则释放该任务的全部预留
+        """
+        with self._condition:
+            for key in [key for key in self._reserved if key[0] == name and stage in (None, key[1])]:
+                self._reserved.pop(key, None)
+                self._actual.pop(key, None)
+            self._condition.notify_all()
+        self._notify_listeners()
+
+    @property
+    def status(self):
+        with self._condition:
+            return {
+                "budget": self.budget,
+                "used": self._used(),
+                "reserved": sum(self._reserved.values()),
+                "actual": sum(self._actual.values()),
+                "entries": len(self._reserved),
+            }
+
+
+@dataclass
+class TaskScheduler:
+    """
+    按大小调度下载任务，替代FIFO队列：在磁盘剩余额度内优先选择能放下的最大任务（best-fit），
+    等待超过max_wait秒的最早任务优先，期间不再调度其他任务，防止大任务饿死
+    接口与Queue的put/get/empty/qsize一致，put(None)表示结束
+    """
+    ledger: DiskLedger = field(init=True)
+    # 计算任务各阶段需要预留的空间
+    footprint: Callable[[tuple], Dict[str, int]] = field(init=True)
+    max_wait: float = field(default=600)
+
+    def __post_init__(self):
+        # (入队时间, 各阶段预留, 任务)
+        self._tasks: List[Tuple[float, Dict[str, int], tuple]] = []
+        self._closed = False
+        self._condition = threading.Condition()
+        self.ledger.listeners.append(self.wake)
+
+    def put(self, task):
+        with self._condition:
+            if task is None:
+                self._closed = True
+            else:
+                self._tasks.append((time.time(), self.footprint(task), task))
+            self._condition.notify_all()
+
+    def wake(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def empty(self) -> bool:
+        with self._condition:
+            return not self._tasks
+
+    def qsize(self) -> int:
+        with self._condition:
+            return len(self._tasks)
+
+    def _pick(self):
+        if not self._tasks:
+            return None
+        oldest = self._tasks[0]
+        if time.time() - oldest[0] >= self.max_wait:
+            # 老化：最早的任务等待过久，只等它
+            candidates = [oldest]
+        else:
+            headroom, budget = self.ledger.headroom, self.ledger.budget
+            # 超过全部额度的任务也放行，由下载阶段报FileTooLarge，不在队列中一直等待
+            fitting = [item for item in self._tasks
+                       if sum(item[1].values()) <= headroom or sum(item[1].values()) > budget]
+            candidates = [max(fitting, key=lambda item: sum(item[1].values()))] if fitting else []
+        for item in candidates:
+            # 调度时即预留空间，避免多个任务按同一份剩余额度被同时放行
+            if self.ledger.try_reserve(item[2][0], item[1]):
+                self._tasks.remove(item)
+                return item[2]
+        return None
+
+    def get(self):
+        with self._condition:
+            while True:
+                if self._closed:
+                    return None
+                task = self._pick()
+                if task is not None:
+                    return task
+                # 等待新任务入队或账本释放空间
+                self._condition.wait()
+
+
 @dataclass
 class ThreadStatus:
     """
@@ -31,20 +287,37 @@ class ThreadStatus:
     """
     # 每个线程控制的最大数量
     max_thread:int = field(init=True)
+    # 脚本允许使用的最大缓存空间，为0则只受磁盘剩余空间限制
     max_spaces:int = field(init=True)
     # 轮询监听时间
     heart:int = field(init=True)
     interface: Optional[str] = field(default=None)  # 新增字段，用于存储网卡名称
+    # 临时目录，磁盘账本按其中各阶段目录的实际大小校正
+    tmp: str = field(default="./tmp")
+    # 任务各阶段需要预留的空间，用于按大小调度下载
+    footprint: Optional[Callable[[tuple], Dict[str, int]]] = field(default=None)
+    # 最早的任务等待超过该秒数后优先调度
+    schedule_max_wait: float = field(default=600)
+    # 全局同时进行的分卷传输数量
+    max_transfers: int = field(default=8)
+    # 解压、压缩、上传阶段的最大并发数，为0则使用CPU逻辑核心数
+    max_decompress: int = field(default=0)
+    max_compress: int = field(default=0)
+    max_upload: int = field(default=0)
+    # 所有7z进程共享的线程预算，为0则使用CPU逻辑核心数
+    cpu_budget: int = field(default=0)
     # 全局线程状态，set则可以继续添加
     download_continue_event: threading.Event =  field(default_factory=threading.Event)
     decompress_continue_event: threading.Event = field(default_factory=threading.Event)
     compress_continue_event: threading.Event = field(default_factory=threading.Event)
     upload_continue_event: threading.Event = field(default_factory=threading.Event)
     # Queue用来全局储存当前*所有*任务的Files_info
-    download_queue: Queue = field(default_factory=Queue)
+    download_queue: Queue = field(default_factory=Queue)  # 指定footprint时替换为TaskScheduler
     decompress_queue:Queue = field(default_factory=Queue)
     compress_queue:Queue = field(default_factory=Queue)
     upload_queue:Queue = field(default_factory=Queue)
+    # 源目录列表是否读取完毕，流式读取时列表未结束不能判定任务全部完成
+    listing_done: threading.Event = field(default_factory=threading.Event)
     # 活跃的下载
     active_download: int = field(default=0)
     active_decompress: int = field(default=0)
@@ -66,18 +339,37 @@ class ThreadStatus:
 
 
     def __post_init__(self):
-        self._totaldisk = self._freedisk = self.max_spaces
-        self._pausedisk = int(0)
+        self.ledger = DiskLedger(self.tmp, max_spaces=self.max_spaces)
+        # 下载队列按大小和剩余额度调度
+        if self.footprint is not None:
+            self.download_queue = TaskScheduler(self.ledger, self.footprint, max_wait=self.schedule_max_wait)
         # 设置事件可继续
         self.download_continue_event.set()
         self.decompress_continue_event.set()
         self.compress_continue_event.set()
         self.upload_continue_event.set()
+        self.listing_done.set()
+        # 任务完成或出错时通知等待的主线程
+        self.finished = threading.Condition(self.aggregate_lock)
         # Threads用于储存所有的Threads,最大值为max_thread
         self.download_threads = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_thread)
-        self.decompress_threads = concurrent.futures.ThreadPoolExecutor()
-        self.compress_threads = concurrent.futures.ThreadPoolExecutor()
-        self.upload_threads = concurrent.futures.ThreadPoolExecutor()
+        cpu_cores = psutil.cpu_count(logical=True) or 1
+        self.max_decompress = self.max_decompress or cpu_cores
+        self.max_compress = self.max_compress or cpu_cores
+        self.max_upload = self.max_upload or cpu_cores
+        self.cpu_budget = self.cpu_budget or cpu_cores
+        self.decompress_threads = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_decompress)
+        self.compress_threads = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_compress)
+        self.upload_threads = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_upload)
+        # 各阶段的并发闸门，初始为最大值，由ConcurrencyController在运行时调整
+        self.limiters = {
+            "download": StageLimiter(self.max_thread, self.max_thread),
+            "decompress": StageLimiter(self.max_decompress, self.max_decompress),
+            "compress": StageLimiter(self.max_compress, self.max_compress),
+            "upload": StageLimiter(self.max_upload, self.max_upload),
+        }
+        # 全局传输预算，所有任务的分卷下载共用
+        self.transfer_semaphore = threading.BoundedSemaphore(self.max_transfers)
 
 
     def update_network_speed(self):
@@ -130,6 +422,15 @@ class ThreadStatus:
             # 轮询休眠 heart 秒
             time.sleep(self.heart)
 
+    def allot_mmt(self) -> int:
+        """
+        按当前活跃的7z任务数量平分线程预算，使 活跃任务数 × mmt ≈ cpu_budget
+        :return: 新任务使用的7z线程数
+        """
+        with self.lock:
+            jobs = max(self.active_decompress + self.active_compress, 1)
+        return max(self.cpu_budget // jobs, 1)
+
     # 在 throttling 属性中添加 active 任务
     @property
     def throttling(self):
@@ -150,8 +451,9 @@ class ThreadStatus:
             available_memory_gb = round(memory.available / (1024 ** 3), 2)  # 可用内存（GB）
 
             return {
-                "totaldisk": self._totaldisk,
-                "pausedisk": self._pausedisk,
+                "totaldisk": self.ledger.budget,
+                "pausedisk": self.ledger.status["used"],
+                "ledger": self.ledger.status,
                 "active": {
                     "active_download": self.active_download,
                     "active_decompress": self.active_decompress,
@@ -179,53 +481,172 @@ class ThreadStatus:
                 }
             }
 
-    @throttling.setter
-    def throttling(self, usedisk):
-        """
-        :param usedisk: 使用的磁盘
-        :return:
-        若 usedisk < 0,则为释放
-        若 usedisk > _totaldisk * 0.9，则直接报错
-        若 usedisk + _pausedisk > _totaldisk * 0.9,则挂起下载，解压，压缩线程池并等待上传完毕后从后到前释放
-        """
-        self._pausedisk += usedisk
-        if usedisk <= 0:
-            logging_capture.info(f"已释放空间{usedisk},目前暂停{self._pausedisk},总空间{self._totaldisk * 0.9}")
-            if self._pausedisk <= self._totaldisk * 0.9 and not self.download_continue_event.is_set():
-                logging_capture.info(f"已有足够空间，释放线程池")
-                # 退出循环
-                self.download_continue_event.set()
-        elif usedisk > 0:
-            if usedisk > self._totaldisk * 0.9:
-                self._pausedisk -= usedisk
-                raise FileTooLarge(f"文件过大，文件大小为{usedisk}字节")
-            if self._pausedisk >= self._totaldisk * 0.9:
-                logging_capture.warning(f"目前已预留空间{self._pausedisk},总空间{self._totaldisk * 0.9},等待目前有释放空间后释放线程")
-                self.download_continue_event.clear()
-
     # 添加方法以更新计数器
 
     def increment_completed(self):
-        with self.aggregate_lock:
+        with self.finished:
             self.total_completed += 1
             self.unfinished_tasks -= 1
+            self.finished.notify_all()
 
     def increment_errors(self):
-        with self.aggregate_lock:
+        with self.finished:
             self.total_errors += 1
             self.unfinished_tasks -= 1
+            self.finished.notify_all()
 
     def add_tasks(self, count: int):
         with self.aggregate_lock:
             self.total_tasks += count
             self.unfinished_tasks += count
 
+@dataclass
+class ConcurrencyController:
+    """
+    自适应并发控制，根据负载、iowait、内存、磁盘繁忙度和网络速度，按加一减一的方式调整各阶段并发上限
+    7z的线程数按CPU预算分配，CPU占满是正常状态，只有可运行的线程数超过核心数（超额订阅）时才降低解压、压缩并发
+    """
+    threadstatus: ThreadStatus = field(init=True)
+    # 采样间隔(秒)
+    interval: float = field(default=5)
+    # 上下行目标速度(Mbps)，低于目标时增加传输并发，为0则不按网速调整
+    upload_target: float = field(default=0)
+    download_target: float = field(default=0)
+    # 超过这些阈值时降低对应阶段的并发
+    # 每个逻辑核心的1分钟平均负载
+    load_high: float = field(default=1.0)
+    iowait_high: float = field(default=20)
+    memory_high: float = field(default=90)
+    disk_busy_high: float = field(default=90)
+
+    def __post_init__(self):
+        self.signals = {}
+        self._prev_disk = psutil.disk_io_counters()
+        self._prev_time = time.time()
+        psutil.cpu_times_percent(interval=None)
+
+    def sample(self):
+        """
+        采样系统指标
+        :return: 各项指标，单位为百分比或Mbps
+        """
+        cpu_times = psutil.cpu_times_percent(interval=None)
+        current_time = time.time()
+        current_disk = psutil.disk_io_counters()
+        disk_busy = None
+        # busy_time 仅Linux提供
+        if current_disk is not None and self._prev_disk is not None and hasattr(current_disk, "busy_time"):
+            elapsed = (current_time - self._prev_time) * 1000
+            if elapsed > 0:
+                disk_busy = min((current_disk.busy_time - self._prev_disk.busy_time) / elapsed * 100, 100)
+        self._prev_disk = current_disk
+        self._prev_time = current_time
+        with self.threadstatus.lock:
+            self.threadstatus.update_network_speed()
+        return {
+            "cpu_percent": 100 - cpu_times.idle,
+            "load_per_core": psutil.getloadavg()[0] / (psutil.cpu_count() or 1),
+            "iowait_percent": getattr(cpu_times, "iowait", 0.0),
+            "memory_percent": psutil.virtual_memory().percent,
+            "disk_busy_percent": disk_busy,
+            "upload_speed_mbps": self.threadstatus._upload_speed,
+            "download_speed_mbps": self.threadstatus._download_speed,
+        }
+
+    def _step(self, stage: str, delta: int, reason: str):
+        limiter = self.threadstatus.limiters[stage]
+        limiter.resize(limiter.limit + delta, reason)
+
+    def adjust(self, signals):
+        """
+        根据指标调整各阶段并发
+        :param signals: sample的返回值
+        """
+        disk_busy = signals["disk_busy_percent"] or 0
+        # 解压、压缩同时受负载和磁盘影响，CPU占用率只用于展示
+        for stage in ("decompress", "compress"):
+            if signals["iowait_percent"] > self.iowait_high:
+                self._step(stage, -1, f"iowait {signals['iowait_percent']:.1f}% 超过 {self.iowait_high}%")
+            elif signals["memory_percent"] > self.memory_high:
+                self._step(stage, -1, f"内存占用 {signals['memory_percent']:.1f}% 超过 {self.memory_high}%")
+            elif signals["load_per_core"] > self.load_high:
+                self._step(stage, -1, f"每核负载 {signals['load_per_core']:.2f} 超过 {self.load_high}")
+            elif disk_busy > self.disk_busy_high:
+                self._step(stage, -1, f"磁盘繁忙度 {disk_busy:.1f}% 超过 {self.disk_busy_high}%")
+            else:
+                self._step(stage, 1, "负载、iowait、内存、磁盘均有余量")
+        # 上传、下载由网速驱动，磁盘过忙时降低下载
+        if disk_busy > self.disk_busy_high:
+            self._step("download", -1, f"磁盘繁忙度 {disk_busy:.1f}% 超过 {self.disk_busy_high}%")
+        elif not self.download_target:
+            # 未设置目标速度时与解压、压缩一致，指标正常即逐步恢复
+            self._step("download", 1, "磁盘有余量")
+        elif signals["download_speed_mbps"] < self.download_target:
+            self._step("download", 1, f"下行 {signals['download_speed_mbps']:.1f}Mbps 低于目标 {self.download_target}Mbps")
+        else:
+            self._step("download", 0, "保持")
+        if signals["memory_percent"] > self.memory_high:
+            self._step("upload", -1, f"内存占用 {signals['memory_percent']:.1f}% 超过 {self.memory_high}%")
+        elif not self.upload_target:
+            self._step("upload", 1, "内存有余量")
+        elif signals["upload_speed_mbps"] < self.upload_target:
+            self._step("upload", 1, f"上行 {signals['upload_speed_mbps']:.1f}Mbps 低于目标 {self.upload_target}Mbps")
+        else:
+            self._step("upload", 0, "保持")
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.signals = self.sample()
+                self.adjust(self.signals)
+            except Exception as e:
+                logging_capture.error(f"自适应并发调整出错: {e}")
+
+    @property
+    def status(self):
+        return {
+            "signals": self.signals,
+            "stages": {stage: limiter.status for stage, limiter in self.threadstatus.limiters.items()},
+        }
+
+
+@dataclass
+class StageEvent:
+    """
+    任务在一个阶段的记录：进入队列、开始执行和结束的时间，处理的字节数，7z线程数和Rclone任务id
+    """
+    name: str = field(init=True)
+    stage: str = field(init=True)
+    queued_at: float = field(init=True)
+    started_at: Optional[float] = field(default=None)
+    bytes_in: int = field(default=0)
+    bytes_out: int = field(default=0)
+    threads: Optional[int] = field(default=None)
+    jobids: List = field(default_factory=list)
+    success: bool = field(default=False)
+
+    def start(self):
+        self.started_at = time.time()
+
+    def record(self):
+        # 统计失败不影响任务本身
+        try:
+            database.record_stage(self.name, self.stage, self.queued_at, self.started_at, time.time(),
+                                  int(self.bytes_in), int(self.bytes_out), self.threads,
+                                  ",".join(map(str, self.jobids)) or None, self.success)
+        except Exception as e:
+            logging_capture.warning(f"记录任务{self.name}的{self.stage}阶段耗时失败: {e}")
+
+
 # ProcessThread 类
 @dataclass
 class ProcessThread:
     download_magnification = 1
     # 正常流控, 按10 % 压缩率算吧
     decompress_magnification = compress_magnification = 1.1
+    # 远端直通判断时读取最后一卷末尾的字节数，需要能包含7z的目录
+    passthrough_tail = 16 * 1024 * 1024
 
     # todo 传入Rclone的参数来启动
 
@@ -237,11 +658,89 @@ class ProcessThread:
         :return: 返回文件名、路径列表和总大小
         """
         name: str = files_info[0]
-        # 所有对应的文件路径和总大小
+        # 所有对应的文件路径和总大小，队列中的任务只带有id和大小，路径在首次使用时读取
+        if 'paths' not in files_info[1]:
+            files_info[1]['paths'] = database.read_paths(name)
         paths: list = files_info[1]['paths']
         sizes: int = files_info[1]['total_size']
         return name, paths, sizes
 
+    @classmethod
+    def task_footprint(cls, files_info):
+        """
+        各阶段需要预留的磁盘空间，已探测过解压后大小的任务使用真实大小，否则按倍率估算
+        :param files_info: 文件信息
+        :return: {阶段: 预留字节}
+        """
+        # 调度器选择任务时调用，不读取路径
+        sizes = files_info[1]['total_size']
+        unpacked_size = files_info[1].get('unpacked_size')
+        return {
+            "download": sizes * cls.download_magnification,
+            "decompress": unpacked_size if unpacked_size else sizes * cls.decompress_magnification,
+            "compress": unpacked_size if unpacked_size else sizes * cls.compress_magnification,
+        }
+
+    @classmethod
+    def resume_queue(cls, files_info):
+        """
+        按数据库中已完成的步骤和临时目录的完整性，选出任务可以继续的最早阶段
+        :param files_info: 文件信息
+        :return: 对应阶段的队列
+        """
+        # 新任务直接进入下载队列，只有需要检查已下载的分卷时才读取路径
+        name: str = files_info[0]
+        step = files_info[1].get('step') or 0
+        if step == 0:
+            return threadstatus.download_queue
+        dirs = cls._get_name(name)
+        # rerun: 将重新执行的阶段的输出目录
+        if step >= 3 and fileprocess.check_compressed(dirs["compress"], name):
+            stage, stages, rerun, queue = "上传", ["compress"], [], threadstatus.upload_queue
+        elif step >= 2 and fileprocess.check_extracted(dirs["decompress"], files_info[1].get('unpacked_size'),
+                                                       files_info[1].get('file_count')):
+            stage, stages, rerun, queue = "压缩", ["decompress", "compress"], ["compress"], threadstatus.compress_queue
+        elif step >= 1 and all(os.path.isfile(os.path.join(dirs["download"], os.path.basename(path)))
+                               for path in cls._parse_files_info(files_info)[1]):
+            stage, stages, rerun, queue = ("解压", ["download", "decompress", "compress"], ["decompress", "compress"],
+                                           threadstatus.decompress_queue)
+        else:
+            stage, stages, rerun, queue = None, [], ["decompress", "compress"], threadstatus.download_queue
+        # 先清空中断时残留的输出，7z无法在已有的分卷上继续写入，解压目录中的残留文件也无法区分
+        for key in rerun:
+            shutil.rmtree(str(dirs[key]), ignore_errors=True)
+        if stage is None:
+            logging_capture.info(f"任务{name}的临时文件不完整，重新下载")
+            return queue
+        footprint = cls.task_footprint(files_info)
+        threadstatus.ledger.restore(name, {key: footprint[key] for key in stages})
+        logging_capture.info(f"任务{name}从{stage}阶段继续")
+        return queue
+
+    @staticmethod
+    def handoff(files_info, queue):
+        """
+        记录进入队列的时间后投递到下一阶段
+        :param files_info: 文件信息
+        :param queue: 下一阶段的队列
+        """
+        files_info[1]['queued_at'] = time.time()
+        queue.put(files_info)
+
+    @staticmethod
+    def _advance(name, step: int):
+        """
+        记录已完成的步骤，租约已被其他工作进程领取时抛出LeaseLost，本进程放弃该任务
+        :param name: 文件名
+        :param step: 已完成的步骤
+        """
+        if not database.update_status(basename=name, step=step):
+            raise LeaseLost(f"任务{name}的租约已被其他工作进程领取")
+
+    @staticmethod
+    def _event(files_info, stage: str) -> StageEvent:
+        return StageEvent(files_info[0], stage, files_info[1].get('queued_at') or time.time())
+
     @staticmethod
     def _get_name(name):
         """
@@ -267,39 +766,240 @@ class ProcessThread:
         :param files_info: 文件信息
         """
         name, paths, sizes = cls._parse_files_info(files_info)
-        pause_sizes = sizes * (cls.download_magnification + cls.decompress_magnification + cls.compress_magnification)
-        release_sizes = 0
+        event = cls._event(files_info, "download")
         try:
             # 等待下载事件被设置
             threadstatus.download_continue_event.wait()
+            threadstatus.limiters["download"].acquire()
             with threadstatus.lock:
                 threadstatus.active_download += 1
-                threadstatus.throttling = pause_sizes
+            if server_passthrough and cls._passthrough(name, paths):
+                # 已符合目标格式，远端直接复制，不占用本地空间
+                logging_capture.info(f"开始远端直通复制: {name}")
+                event.stage = "passthrough"
+                event.start()
+                threadstatus.ledger.release(name)
+                with threadstatus.transfer_semaphore:
+                    result = rclone.copy_files(paths, cls._get_name(name)["upload"], _async=async_jobs)
+                    if async_jobs:
+                        event.jobids.append(result.jobid)
+                        result.result()
+                event.bytes_in = event.bytes_out = sizes
+                event.success = True
+                logging_capture.info(f"远端直通复制完成: {name}")
+                database.update_status(basename=name, step=4, status=1)
+                threadstatus.increment_completed()
+                return
+            # 准入时一次性预留所有阶段的空间，后续阶段不会因空间不足而卡死
+            threadstatus.ledger.reserve(name, cls.task_footprint(files_info))
+            event.start()
             logging_capture.info(f"开始下载: {name}，大小{sizes}字节")
-            for file in paths:
-                rclone.copyfile(file, cls._get_name(name)["download"], replace_name=None)
+            split = fileprocess.split_volumes(paths) if early_probe else None
+            if split and len(split) > 2:
+                event.jobids = cls._download_split(files_info, split)
+            else:
+                event.jobids = cls._download_volumes(name, paths)
+            event.bytes_in = event.bytes_out = sizes
+            event.success = True
             logging_capture.info(f"下载步骤完成: {name}")
-            database.update_status(basename=name, step=1)
+            cls._advance(name, 1)
             # 添加到解压Queue当前files_info
-            threadstatus.decompress_queue.put(files_info)
+            cls.handoff(files_info, threadstatus.decompress_queue)
         except (RcloneError, FileTooLarge) as e:
             logging_capture.error(f"当前任务{name}下载过程出错: {e}")
             database.update_status(basename=name, step=1, status=3, log=str(e))
             # 更新总错误任务数
             threadstatus.increment_errors()
-            threadstatus.throttling = -pause_sizes
+            threadstatus.ledger.release(name)
+            shutil.rmtree(str(cls._get_name(name)["download"]), ignore_errors=True)
+        except LeaseLost as e:
+            logging_capture.warning(f"{e}，放弃该任务")
+            threadstatus.increment_errors()
+            threadstatus.ledger.release(name)
             shutil.rmtree(str(cls._get_name(name)["download"]), ignore_errors=True)
         except Exception as e:
             logging_capture.error(f"当前任务{name}下载过程未知出错: {e}")
             database.update_status(basename=name, step=1, status=4, log=str(e))
             # 更新总错误任务数
             threadstatus.increment_errors()
-            threadstatus.throttling = -pause_sizes
+            threadstatus.ledger.release(name)
             shutil.rmtree(str(cls._get_name(name)["download"]), ignore_errors=True)
         finally:
-            threadstatus.throttling = -release_sizes
+            event.record()
             with threadstatus.lock:
                 threadstatus.active_download -= 1
+            threadstatus.limiters["download"].release()
+
+    @classmethod
+    def _passthrough(cls, name, paths) -> bool:
+        """
+        判断任务是否已符合压缩阶段的输出，可以跳过下载、解压、压缩直接远端复制
+        文件名和大小符合目标分卷，且只用远端读取的开头和末尾就能读取压缩包头并确认加密方式与目标一致
+        数据加密而头部未加密的压缩包无法在不下载数据的情况下验证密码，仍走完整流程
+        :param name: 文件名
+        :param paths: 分卷路径列表
+        """
+        ordered = fileprocess.split_volumes(paths) or paths
+        if len(ordered) != len(paths) or len({rclone.split_dir(path)[0] for path in ordered}) != 1:
+            return False
+        # 先只按文件名排除.rar、.zip等不可能符合的任务，避免每个任务都列出一次所在目录
+        if not fileprocess.target_names([rclone.split_dir(path)[1] for path in ordered], fileprocess.volume_bytes(volumes)):
+            return False
+        try:
+            listed = {
+                entry["Name"]: entry["Size"]
+                for entry in rclone.lsjson(rclone.split_dir(ordered[0])[0], {"filesOnly": True, "noMimeType": True})["list"]
+            }
+            sized = [(rclone.split_dir(path)[1], listed.get(rclone.split_dir(path)[1], 0)) for path in ordered]
+            if not fileprocess.target_layout(sized, fileprocess.volume_bytes(volumes)):
+                return False
+            # 7z的起始头共32字节，记录目录的位置
+            head = rclone.cat(ordered[0], head=32)
+            if not head.startswith(fileprocess.signature_7z):
+                return False
+            tail = rclone.cat(ordered[-1], tail=min(cls.passthrough_tail, sized[-1][1]))
+        except RcloneError as e:
+            logging_capture.debug(f"{name}无法读取远端压缩包头，按普通任务处理: {e}")
+            return False
+        os.makedirs(tmp, exist_ok=True)
+        info = fileprocess.probe_sparse(tmp, sized, head, tail, [password] if password else None)
+        if info is None:
+            return False
+        if password:
+            return info['password'] == password
+        return not any(entry.get('Encrypted') == '+' for entry in info['entries'])
+
+    @staticmethod
+    def _use_filter_copy(paths) -> bool:
+        """
+        判断是否使用单次过滤复制下载：所在远端开启了filter_copy且所有分卷位于同一目录
+        :param paths: 分卷路径列表
+        """
+        if len(paths) < 2 or not filter_copy:
+            return False
+        fs, _ = rclone.extract_parts(paths[0])
+        if "*" not in filter_copy and fs not in filter_copy:
+            return False
+        return len({rclone.split_dir(path)[0] for path in paths}) == 1
+
+    @classmethod
+    def _download_volumes(cls, name, paths):
+        """
+        并发下载同一任务的所有分卷，单个任务并发受volume_transfers限制，全局受max_transfers限制
+        所有分卷完成后才返回，任一分卷失败则抛出异常
+        :param name: 文件名
+        :param paths: 分卷路径列表
+        :return: 异步模式下的Rclone任务id列表
+        """
+        target = cls._get_name(name)["download"]
+        if cls._use_filter_copy(paths):
+            # 同一目录下的分卷用一次带过滤的 /sync/copy 下载，由Rclone自行调度
+            with threadstatus.transfer_semaphore:
+                result = rclone.copy_files(paths, target, _async=async_jobs)
+                if async_jobs:
+                    result.result()
+                    return [result.jobid]
+            return []
+        task_slots = threading.BoundedSemaphore(max(volume_transfers, 1))
+
+        def release(_=None):
+            threadstatus.transfer_semaphore.release()
+            task_slots.release()
+
+        if async_jobs:
+            # 异步模式下由当前线程按预算提交，完成回调归还名额，不额外占用线程
+            jobs = []
+            for file in paths:
+                task_slots.acquire()
+                threadstatus.transfer_semaphore.acquire()
+                try:
+                    job = rclone.copyfile(file, target, replace_name=None, _async=True)
+                except Exception:
+                    release()
+                    raise
+                job.add_done_callback(release)
+                jobs.append(job)
+            for job in jobs:
+                job.result()
+            return [job.jobid for job in jobs]
+
+        def copy_volume(file):
+            task_slots.acquire()
+            threadstatus.transfer_semaphore.acquire()
+            try:
+                return rclone.copyfile(file, target, replace_name=None)
+            finally:
+                release()
+
+        executor = ThreadPoolExecutor(max_workers=max(min(volume_transfers, len(paths)), 1))
+        try:
+            futures = [executor.submit(copy_volume, file) for file in paths]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except Exception:
+            # 任一分卷失败则取消尚未开始的分卷
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        executor.shutdown(wait=True)
+        return []
+
+    @classmethod
+    def _download_split(cls, files_info, volumes):
+        """
+        按字节切分的分卷先下载第一卷和最后一卷，剩余分卷下载期间读取压缩包头，结果保存在files_info中供解压阶段复用
+        7z和zip的目录位于末尾，7z无法从不断增长的数据流中解压，能提前进行的是探测大小和头部密码
+        :param files_info: 文件信息
+        :param volumes: 按序号排序的分卷路径
+        :return: 异步模式下的Rclone任务id列表
+        """
+        name = files_info[0]
+        jobids = cls._download_volumes(name, [volumes[0], volumes[-1]])
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            remaining = executor.submit(cls._download_volumes, name, volumes[1:-1])
+            ranked = database.rank_passwords(*fileprocess.password_key(volumes[0]), passwords)
+            info = fileprocess.probe_partial(cls._get_name(name)["download"],
+                                             [os.path.basename(volume) for volume in volumes], ranked)
+            if info is not None:
+                cls._apply_probe(name, info)
+                files_info[1]['probe'] = info
+            return jobids + remaining.result()
+        finally:
+            executor.shutdown(wait=True)
+
+    @classmethod
+    def _first_volume(cls, name, paths):
+        """
+        :return: 已下载到本地的第一卷路径
+        """
+        return os.path.join(cls._get_name(name)["download"], os.path.basename(fileprocess.first_volume(paths))).replace("\\", "/")
+
+    @classmethod
+    def _probe(cls, name, paths, candidates):
+        """
+        读取已下载的第一卷的压缩包头，用真实的解压后大小替换解压、压缩阶段按倍率估算的预留
+        :param name: 文件名
+        :param paths: 分卷路径列表
+        :param candidates: 按命中率排序后的密码列表
+        """
+        info = fileprocess.probe(cls._first_volume(name, paths), candidates)
+        if info is None:
+            logging_capture.debug(f"无法读取{name}的压缩包头，继续使用估算大小")
+            return None
+        cls._apply_probe(name, info)
+        return info
+
+    @classmethod
+    def _apply_probe(cls, name, info):
+        """
+        记录探测结果并按真实大小调整预留
+        :param name: 文件名
+        :param info: probe的返回值
+        """
+        logging_capture.info(f"{name}解压后大小{info['size']}字节，共{info['files']}个文件")
+        database.update_probe(name, info['size'], info['files'])
+        # 仅储存时压缩结果与解压后大小基本一致
+        threadstatus.ledger.adjust(name, {"decompress": info['size'], "compress": info['size']})
 
     @classmethod
     def decompress_thread(cls, files_info):
@@ -308,26 +1008,78 @@ class ProcessThread:
         :param files_info: 文件信息
         """
         name, paths, sizes = cls._parse_files_info(files_info)
-        pause_sizes = sizes * (cls.decompress_magnification + cls.compress_magnification)
-        release_sizes = sizes * cls.download_magnification
+        event = cls._event(files_info, "decompress")
         try:
             # 等待解压事件被设置
             threadstatus.decompress_continue_event.wait()
+            threadstatus.limiters["decompress"].acquire()
             with threadstatus.lock:
                 threadstatus.active_decompress += 1
+            event.start()
+            event.bytes_in = sizes
+            event.threads = mmt or threadstatus.allot_mmt()
             # todo 增加错误重试,这里有坑，不能多次解压已成功的，没有抓响应码
-            logging_capture.info(f"开始解压: {name}")
-            fileprocess.decompress(cls._get_name(name)["download"], cls._get_name(name)["decompress"], passwords=passwords)
-            logging_capture.info(f"解压步骤完成: {name}")
-            database.update_status(basename=name, step=2)
-            # 添加到压缩Queue当前files_info
-            threadstatus.compress_queue.put(files_info)
+            # depth不为0时一个分组可能包含多个压缩包，每个压缩包单独确定密码并解压
+            archives = []
+            for volume_set in fileprocess.volume_sets(paths):
+                # 同一来源的压缩包通常使用相同的密码，按历史命中排序
+                password_key = fileprocess.password_key(volume_set[0])
+                archives.append((cls._first_volume(name, volume_set), password_key,
+                                 database.rank_passwords(*password_key, passwords)))
+            if not archives:
+                raise NoExistDecompressDir(f"任务{name}没有可解压的压缩包")
+            if len(archives) == 1:
+                infos = [files_info[1].get('probe') or cls._probe(name, paths, archives[0][2])]
+            else:
+                infos = [fileprocess.probe(archive, ranked) for archive, _, ranked in archives]
+                if all(info is not None for info in infos):
+                    cls._apply_probe(name, {'size': sum(info['size'] for info in infos),
+                                            'files': sum(info['files'] for info in infos)})
+            streamed = False
+            if stream_transcode and len(archives) == 1 and infos[0] is not None and infos[0]['files'] == 1:
+                # 单文件压缩包直接管道转压，跳过解压落地和压缩阶段
+                archive, password_key, ranked = archives[0]
+                logging_capture.info(f"开始流式转压: {name}")
+                event.stage = "transcode"
+                try:
+                    used_password = fileprocess.find_password(archive, ranked, infos[0])
+                    fileprocess.transcode(archive, cls._get_name(name)["compress"], name,
+                                          infos[0]['entries'][0]['Path'], pwd=used_password, password=password, mx=mx,
+                                          volumes=volumes, mmt=event.threads)
+                    streamed = True
+                except (UnpackError, PackError) as e:
+                    # 无法通过管道处理的压缩包回退到解压后压缩，转压没有使用-sdel，下载的分卷仍在
+                    logging_capture.warning(f"{name}流式转压失败，改为解压后压缩: {e}")
+                    event.stage = "decompress"
+            if streamed:
+                if used_password:
+                    database.record_password(*password_key, used_password)
+                event.bytes_out = fileprocess.get_dir_size(cls._get_name(name)["compress"])
+                event.success = True
+                logging_capture.info(f"流式转压完成: {name}")
+                cls._advance(name, 3)
+                threadstatus.ledger.release(name, "decompress")
+                # 添加到上传Queue当前files_info
+                cls.handoff(files_info, threadstatus.upload_queue)
+            else:
+                logging_capture.info(f"开始解压: {name}，共{len(archives)}个压缩包")
+                for (archive, password_key, ranked), info in zip(archives, infos):
+                    _, used_password = fileprocess.decompress(archive, cls._get_name(name)["decompress"],
+                                                              passwords=ranked, mmt=event.threads, info=info)
+                    if used_password:
+                        database.record_password(*password_key, used_password)
+                event.bytes_out = fileprocess.get_dir_size(cls._get_name(name)["decompress"])
+                event.success = True
+                logging_capture.info(f"解压步骤完成: {name}")
+                cls._advance(name, 2)
+                # 添加到压缩Queue当前files_info
+                cls.handoff(files_info, threadstatus.compress_queue)
         except NoRightPasswd:
             log = f"当前任务{name}无正确的解压密码"
             logging_capture.warning(log)
             database.update_status(basename=name, step=2, status=2, log=log)
             # 更新总错误任务数
-            threadstatus.throttling = -pause_sizes
+            threadstatus.ledger.release(name)
             threadstatus.increment_errors()
             shutil.rmtree(str(cls._get_name(name)["decompress"]), ignore_errors=True)
         except NoExistDecompressDir:
@@ -335,7 +1087,7 @@ class ProcessThread:
             logging_capture.warning(log)
             database.update_status(basename=name, step=2, status=3, log=log)
             # 更新总错误任务数
-            threadstatus.throttling = -pause_sizes
+            threadstatus.ledger.release(name)
             threadstatus.increment_errors()
             shutil.rmtree(str(cls._get_name(name)["decompress"]), ignore_errors=True)
         except UnpackError as e:
@@ -343,23 +1095,31 @@ class ProcessThread:
             logging_capture.error(log)
             database.update_status(basename=name, step=2, status=3, log=log)
             # 更新总错误任务数
-            threadstatus.throttling = -pause_sizes
+            threadstatus.ledger.release(name)
+            threadstatus.increment_errors()
+            shutil.rmtree(str(cls._get_name(name)["decompress"]), ignore_errors=True)
+        except LeaseLost as e:
+            logging_capture.warning(f"{e}，放弃该任务")
+            threadstatus.ledger.release(name)
             threadstatus.increment_errors()
             shutil.rmtree(str(cls._get_name(name)["decompress"]), ignore_errors=True)
+            shutil.rmtree(str(cls._get_name(name)["compress"]), ignore_errors=True)
         except Exception as e:
             log = f"当前任务{name}解压过程未知出错: {e}"
             logging_capture.error(log)
             database.update_status(basename=name, step=2, status=4, log=log)
             # 更新总错误任务数
-            threadstatus.throttling = -pause_sizes
+            threadstatus.ledger.release(name)
             threadstatus.increment_errors()
             shutil.rmtree(str(cls._get_name(name)["decompress"]), ignore_errors=True)
         finally:
+            event.record()
             # 释放下载阶段占用的磁盘空间
             shutil.rmtree(str(cls._get_name(name)["download"]), ignore_errors=True)
-            threadstatus.throttling = -release_sizes
+            threadstatus.ledger.release(name, "download")
             with threadstatus.lock:
                 threadstatus.active_decompress -= 1
+            threadstatus.limiters["decompress"].release()
 
     @classmethod
     def compress_thread(cls, files_info):
@@ -368,33 +1128,60 @@ class ProcessThread:
         :param files_info: 文件信息
         """
         name, paths, sizes = cls._parse_files_info(files_info)
-        pause_sizes = sizes * cls.compress_magnification
-        release_sizes = sizes * cls.decompress_magnification
+        event = cls._event(files_info, "compress")
+        uploads = []
         try:
             # 等待压缩事件被设置
             threadstatus.compress_continue_event.wait()
+            threadstatus.limiters["compress"].acquire()
             with threadstatus.lock:
                 threadstatus.active_compress += 1
+            event.start()
+            event.bytes_in = fileprocess.get_dir_size(cls._get_name(name)["decompress"])
+            event.threads = mmt or threadstatus.allot_mmt()
             logging_capture.info(f"开始压缩: {name}")
-            # noinspection PyTypeChecker
-            fileprocess.compress(
-                cls._get_name(name)["decompress"],
-                cls._get_name(name)["compress"],
-                password=password,
-                mx=mx,
-                volumes=volumes
-            )
+            # 边压缩边上传已写完的分卷，剩余的第一卷和最后一卷由上传阶段处理
+            volume_uploads = ThreadPoolExecutor(max_workers=max(volume_transfers, 1)) if pipeline_upload else None
+
+            def on_volume(volume):
+                event.bytes_out += os.path.getsize(volume)
+                uploads.append(volume_uploads.submit(cls._upload_volume, name, volume))
+
+            try:
+                # noinspection PyTypeChecker
+                fileprocess.compress(
+                    cls._get_name(name)["decompress"],
+                    cls._get_name(name)["compress"],
+                    password=password,
+                    mx=mx,
+                    volumes=volumes,
+                    mmt=event.threads,
+                    on_volume=on_volume if volume_uploads else None
+                )
+                for upload in uploads:
+                    upload.result()
+            finally:
+                if volume_uploads:
+                    volume_uploads.shutdown(wait=True, cancel_futures=True)
+            event.bytes_out += fileprocess.get_dir_size(cls._get_name(name)["compress"])
+            event.success = True
             logging_capture.info(f"压缩步骤完成: {name}")
-            database.update_status(basename=name, step=3)
+            cls._advance(name, 3)
             # 添加到上传Queue当前files_info
-            threadstatus.upload_queue.put(files_info)
-        except PackError as e:
+            cls.handoff(files_info, threadstatus.upload_queue)
+        except (PackError, RcloneError) as e:
             log = f"当前任务{name}压缩过程出错: {e}"
             logging_capture.error(log)
             database.update_status(basename=name, step=3, status=3, log=log)
             # 更新总错误任务数
             threadstatus.increment_errors()
-            threadstatus.throttling = -pause_sizes
+            threadstatus.ledger.release(name)
+            shutil.rmtree(str(cls._get_name(name)["compress"]), ignore_errors=True)
+            cls._discard_uploaded(name, uploads)
+        except LeaseLost as e:
+            logging_capture.warning(f"{e}，放弃该任务")
+            threadstatus.increment_errors()
+            threadstatus.ledger.release(name)
             shutil.rmtree(str(cls._get_name(name)["compress"]), ignore_errors=True)
         except Exception as e:
             log = f"当前任务{name}压缩过程未知出错: {e}"
@@ -402,31 +1189,90 @@ class ProcessThread:
             database.update_status(basename=name, step=3, status=4, log=log)
             # 更新总错误任务数
             threadstatus.increment_errors()
-            threadstatus.throttling = -pause_sizes
+            threadstatus.ledger.release(name)
             shutil.rmtree(str(cls._get_name(name)["compress"]), ignore_errors=True)
+            cls._discard_uploaded(name, uploads)
         finally:
+            event.record()
             # 释放解压阶段占用的磁盘空间
             shutil.rmtree(str(cls._get_name(name)["decompress"]), ignore_errors=True)
-            threadstatus.throttling = -release_sizes
+            threadstatus.ledger.release(name, "decompress")
             with threadstatus.lock:
                 threadstatus.active_compress -= 1
+            threadstatus.limiters["compress"].release()
+
+    @classmethod
+    def _upload_volume(cls, name, volume):
+        """
+        上传压缩过程中已写完的分卷，Rclone校验通过后删除本地分卷
+        :param name: 文件名
+        :param volume: 本地分卷路径
+        """
+        srcfs, srcremote = rclone.extract_parts(volume)
+        dstfs, dstremote = rclone.extract_parts(cls._get_name(name)["upload"])
+        dstremote = os.path.join(dstremote, os.path.basename(srcremote)).replace("\\", "/")
+        with threadstatus.transfer_semaphore:
+            # 目标在远端，直接调用Rclone.movefile，避免OwnRclone.movefile按远端路径在本地创建目录
+            result = Rclone.movefile(rclone, srcfs, srcremote, dstfs, dstremote, _async=async_jobs)
+            if async_jobs:
+                result.result()
+        logging_capture.debug(f"分卷上传完成: {os.path.basename(volume)}")
+
+    @classmethod
+    def _discard_uploaded(cls, name, uploads):
+        """
+        压缩失败时删除已提前上传到目标目录的分卷，避免目标中留下不完整的分卷组
+        :param name: 文件名
+        :param uploads: 分卷上传的Future列表
+        """
+        if not uploads:
+            return
+        try:
+            rclone.purge(cls._get_name(name)["upload"])
+            logging_capture.info(f"已删除{name}提前上传的分卷")
+        except RcloneError as e:
+            logging_capture.error(f"删除{name}提前上传的分卷失败，请手动清理{cls._get_name(name)['upload']}: {e}")
 
     @classmethod
     def upload_thread(cls, files_info):
         """
-        上传线程
+        上传线程，异步模式下提交任务后立即返回，由JobPoller完成后回调_upload_done
         :param files_info: 文件信息
         """
         name, paths, sizes = cls._parse_files_info(files_info)
-        pause_sizes = 0
-        release_sizes = sizes * cls.compress_magnification
+        event = cls._event(files_info, "upload")
+        # 等待上传事件被设置
+        threadstatus.upload_continue_event.wait()
+        threadstatus.limiters["upload"].acquire()
+        with threadstatus.lock:
+            threadstatus.active_upload += 1
+        event.start()
+        logging_capture.info(f"开始上传: {name}")
         try:
-            # 等待上传事件被设置
-            threadstatus.upload_continue_event.wait()
-            with threadstatus.lock:
-                threadstatus.active_upload += 1
-            logging_capture.info(f"开始上传: {name}")
-            rclone.move(cls._get_name(name)["compress"], cls._get_name(name)["upload"])
+            event.bytes_in = event.bytes_out = fileprocess.get_dir_size(cls._get_name(name)["compress"])
+            job = rclone.move(cls._get_name(name)["compress"], cls._get_name(name)["upload"], _async=async_jobs)
+        except Exception as e:
+            cls._upload_done(files_info, e, event)
+            return
+        if async_jobs:
+            event.jobids.append(job.jobid)
+            job.add_done_callback(lambda f: cls._upload_done(files_info, f.exception(), event))
+        else:
+            cls._upload_done(files_info, None, event)
+
+    @classmethod
+    def _upload_done(cls, files_info, error: Optional[BaseException], event: StageEvent):
+        """
+        上传结束后的收尾
+        :param files_info: 文件信息
+        :param error: 上传过程中的异常，成功则为None
+        :param event: 上传阶段的记录
+        """
+        name, paths, sizes = cls._parse_files_info(files_info)
+        try:
+            if error is not None:
+                raise error
+            event.success = True
             logging_capture.info(f"上传步骤完成: {name}")
             database.update_status(basename=name, step=4, status=1)
             # 更新总完成任务数
@@ -436,100 +1282,84 @@ class ProcessThread:
             logging_capture.error(log)
             database.update_status(basename=name, step=4, status=3, log=log)
             # 更新总错误任务数
-            threadstatus.throttling = -pause_sizes
+            threadstatus.ledger.release(name)
             threadstatus.increment_errors()
         except Exception as e:
             log = f"当前任务{name}上传过程未知出错: {e}"
             logging_capture.error(log)
             database.update_status(basename=name, step=4, status=4, log=log)
             # 更新总错误任务数
-            threadstatus.throttling = -pause_sizes
+            threadstatus.ledger.release(name)
             threadstatus.increment_errors()
         finally:
+            event.record()
             # 释放压缩阶段占用的磁盘空间
             shutil.rmtree(str(cls._get_name(name)["compress"]), ignore_errors=True)
-            threadstatus.throttling = -release_sizes
+            threadstatus.ledger.release(name, "compress")
             with threadstatus.lock:
                 threadstatus.active_upload -= 1
+            threadstatus.limiters["upload"].release()
 
     @staticmethod
     def parse_return_result(future):
         """
-        处理线程完成后的结果（当前暂未实现）
+        处理线程完成后的结果，各阶段已自行处理异常，逃逸出来的异常说明收尾失败，按错误任务计数防止流水线无法结束
         :param future: 线程Future对象
         """
-        pass
+        error = future.exception()
+        if error is not None:
+            logging_capture.error(f"线程异常退出: {error}")
+            threadstatus.increment_errors()
 
     @classmethod
-    def _start_threads(cls, function: Callable, queue: Queue, threads: ThreadPoolExecutor) -> list[Future[Any]]:
+    def _consume(cls, function: Callable, queue: Queue, threads: ThreadPoolExecutor):
         """
-        启动线程池中的任务
+        阶段消费者，阻塞等待队列中的任务并立即提交到线程池，收到None时退出
         :param function: 要执行的函数
         :param queue: 任务队列
         :param threads: 线程池执行器
-        :return: 返回Future对象列表
         """
-        futures = []
-        while not queue.empty():
-            try:
-                # 获取任务
-                data = queue.get_nowait()
-            except Empty:
+        while True:
+            data = queue.get()
+            if data is None:
                 break
             # 提交任务但不等待
             future = threads.submit(function, data)
-            # 为每个future添加回调，但不等待完成
-            future.add_done_callback(lambda f: cls.parse_return_result(f))
-            futures.append(future)
-        return futures
+            future.add_done_callback(cls.parse_return_result)
 
     @classmethod
     def start_threads(cls, heart):
         """
-        启动所有阶段的线程，并持续监控任务状态
-        :param heart: 轮询间隔时间（秒）
+        为每个阶段启动一个消费者线程，任务进入队列后立即开始处理，等待所有任务结束
+        :param heart: 兜底检查间隔时间（秒）
         """
-        total_futures = set()
-        # 循环启动各阶段的线程
-        while True:
-            # 启动下载线程
-            download_futures = cls._start_threads(
-                function=cls.download_thread,
-                queue=threadstatus.download_queue,
-                threads=threadstatus.download_threads
-            )
-            # 启动解压线程
-            decompress_futures = cls._start_threads(
-                function=cls.decompress_thread,
-                queue=threadstatus.decompress_queue,
-                threads=threadstatus.decompress_threads
-            )
-            # 启动压缩线程
-            compress_futures = cls._start_threads(
-                function=cls.compress_thread,
-                queue=threadstatus.compress_queue,
-                threads=threadstatus.compress_threads
-            )
-            # 启动上传线程
-            upload_futures = cls._start_threads(
-                function=cls.upload_thread,
-                queue=threadstatus.upload_queue,
-                threads=threadstatus.upload_threads
-            )
-            # 将所有新的Future加入总集合
-            for futures in [download_futures, decompress_futures, compress_futures, upload_futures]:
-                total_futures.update(futures)
-            # 检查所有任务是否完成
-            if all(future.done() for future in total_futures) and \
-               threadstatus.download_queue.empty() and \
-               threadstatus.decompress_queue.empty() and \
-               threadstatus.compress_queue.empty() and \
-               threadstatus.upload_queue.empty():
-                logging_capture.info("所有任务已完成")
-                rclone.stop_rclone()
-                break
-            # 轮询休眠heart秒
-            time.sleep(heart)
+        stages = [
+            (cls.download_thread, threadstatus.download_queue, threadstatus.download_threads),
+            (cls.decompress_thread, threadstatus.decompress_queue, threadstatus.decompress_threads),
+            (cls.compress_thread, threadstatus.compress_queue, threadstatus.compress_threads),
+            (cls.upload_thread, threadstatus.upload_queue, threadstatus.upload_threads),
+        ]
+        consumers = [
+            threading.Thread(target=cls._consume, args=stage, name=f"{stage[0].__name__}_consumer", daemon=True)
+            for stage in stages
+        ]
+        for consumer in consumers:
+            consumer.start()
+        # 由完成/错误计数器通知，列表读取完毕且没有未完成的任务即结束
+        with threadstatus.finished:
+            while not threadstatus.finished.wait_for(
+                    lambda: threadstatus.listing_done.is_set() and threadstatus.unfinished_tasks <= 0,
+                    timeout=heart):
+                pass
+        logging_capture.info("所有任务已完成")
+        for _, queue, threads in stages:
+            queue.put(None)
+        for consumer in consumers:
+            consumer.join()
+        for _, _, threads in stages:
+            threads.shutdown(wait=True)
+        rclone.stop_rclone()
+        database.close()
 
 
 @contextmanager
@@ -551,6 +1381,12 @@ def log_level_type(level_str):
     except AttributeError:
         raise argparse.ArgumentTypeError(f"Invalid log level: {level_str}")
 
+def bool_type(value):
+    # 转换Env的布尔值
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
 def load_env():
     # 读取环境变量
     parser = argparse.ArgumentParser(description="自动化任务处理脚本")
@@ -567,33 +1403,249 @@ def load_env():
     parser.add_argument('--tmp', type=str, default=os.getenv('TMP', './tmp'), help='临时目录路径')
     parser.add_argument('--heart', type=int, default=os.getenv('HEART', 10), help='监听轮询时间，默认10')
     parser.add_argument('--mx', type=int, default=int(os.getenv('MX', 0)), help='压缩等级，默认为0即仅储存')
-    parser.add_argument('--mmt', type=int, default=int(os.getenv('MMT', 4)), help='解压缩线程数')
+    parser.add_argument('--mmt', type=int, default=int(os.getenv('MMT', 0)), help='解压缩线程数，为0则按活跃的7z任务数平分cpu_budget')
+    parser.add_argument('--cpu_budget', type=int, default=int(os.getenv('CPU_BUDGET', 0)), help='所有7z进程共享的线程预算，为0则使用CPU逻辑核心数')
+    parser.add_argument('--max_decompress', type=int, default=int(os.getenv('MAX_DECOMPRESS', 0)), help='同时解压的最大任务数，为0则使用CPU逻辑核心数')
+    parser.add_argument('--max_compress', type=int, default=int(os.getenv('MAX_COMPRESS', 0)), help='同时压缩的最大任务数，为0则使用CPU逻辑核心数')
+    parser.add_argument('--max_upload', type=int, default=int(os.getenv('MAX_UPLOAD', 0)), help='同时上传的最大任务数，为0则使用CPU逻辑核心数')
     parser.add_argument('--volumes', type=str, default=os.getenv('VOLUMES', '4g'), help='分卷大小')
     parser.add_argument('--logfile', type=str, default=os.getenv('LOGFILE', 'AutoRclone.log'), help='日志文件路径')
     parser.add_argument('--depth', type=int, default=int(os.getenv('DEPTH', 0)), help='使用路径中的目录作为最终文件夹名的探测深度,为0则使用文件名，例如 Alist:c/a/b.zip 0使用b为文件名，1使用a')
     parser.add_argument('--loglevel',type=log_level_type,default=os.getenv('LOGLEVEL', "INFO"), help='Log level (DEBUG, INFO, WARNING, ERROR, CRITICAL)')
     parser.add_argument('--console_log',type=bool,default=os.getenv('CONSOLE_LOG', True),help='是否输出到控制台')
-    parser.add_argument('--max_spaces',type=int,default=os.getenv("MAX_SPACES",0),help='脚本允许使用的最大缓存空间,单位字节，为0为不限制（均预留10%容灾空间）')
+    parser.add_argument('--max_spaces',type=int,default=int(os.getenv("MAX_SPACES",0)),help='脚本允许使用的最大缓存空间,单位字节，为0为不限制（均预留10%容灾空间）')
     parser.add_argument('--interface', type=str, default=os.getenv('INTERFACE', None), help='指定要监控的网络接口名称')
+    parser.add_argument('--rc_connect_timeout', type=float, default=float(os.getenv('RC_CONNECT_TIMEOUT', 5)), help='Rclone RC连接超时(秒)')
+    parser.add_argument('--volume_transfers', type=int, default=int(os.getenv('VOLUME_TRANSFERS', 4)), help='单个任务同时下载的分卷数量')
+    parser.add_argument('--max_transfers', type=int, default=int(os.getenv('MAX_TRANSFERS', 8)), help='全局同时下载的分卷数量上限')
+    parser.add_argument('--filter_copy', nargs='*', default=os.getenv('FILTER_COPY', '').split(), help='使用单次过滤复制下载分卷的远端列表，例如 Alist:，*为全部')
+    parser.add_argument('--stream_listing', type=bool_type, default=os.getenv('STREAM_LISTING', False), help='以子进程流式读取源目录列表，边读取边开始处理')
+    parser.add_argument('--stream_batch', type=int, default=int(os.getenv('STREAM_BATCH', 1000)), help='流式读取时每批写入数据库的任务数量')
+    parser.add_argument('--incremental', type=bool_type, default=os.getenv('INCREMENTAL', False), help='保存源目录列表快照，每次只处理新增、变化和删除的文件')
+    parser.add_argument('--skip_unchanged_dirs', type=bool_type, default=os.getenv('SKIP_UNCHANGED_DIRS', False), help='增量扫描时跳过修改时间未变化的目录，需要远端的目录修改时间能反映子树变化')
+    parser.add_argument('--watch', type=int, default=int(os.getenv('WATCH', 0)), help='监听模式的重新扫描间隔(秒)，为0则只运行一次')
+    parser.add_argument('--adaptive', type=bool_type, default=os.getenv('ADAPTIVE', False), help='根据CPU、内存、磁盘和网络指标自动调整各阶段并发')
+    parser.add_argument('--control_interval', type=float, default=float(os.getenv('CONTROL_INTERVAL', 5)), help='自适应并发的采样间隔(秒)')
+    parser.add_argument('--upload_target', type=float, default=float(os.getenv('UPLOAD_TARGET', 0)), help='上行目标速度(Mbps)，低于目标时增加上传并发')
+    parser.add_argument('--download_target', type=float, default=float(os.getenv('DOWNLOAD_TARGET', 0)), help='下行目标速度(Mbps)，低于目标时增加下载并发')
+    parser.add_argument('--schedule_max_wait', type=float, default=float(os.getenv('SCHEDULE_MAX_WAIT', 600)), help='按大小调度时，最早的任务等待超过该秒数后优先调度')
+    parser.add_argument('--feed_page', type=int, default=int(os.getenv('FEED_PAGE', 1000)), help='每次从数据库读取的任务数，下载队列积压少于一页时读取下一页')
+    parser.add_argument('--lease', type=float, default=float(os.getenv('LEASE', 0)), help='多个工作进程共用数据库时的任务租约时长(秒)，为0则不使用租约')
+    parser.add_argument('--worker_id', type=str, default=os.getenv('WORKER_ID', ''), help='工作进程标识，默认为主机名:进程号')
+    parser.add_argument('--rc_addr', type=str, default=os.getenv('RC_ADDR', '127.0.0.1:4572'), help='Rclone RC监听地址，同一主机运行多个工作进程时需不同')
+    parser.add_argument('--server_passthrough', type=bool_type, default=os.getenv('SERVER_PASSTHROUGH', False), help='已符合目标格式的压缩包直接远端复制')
+    parser.add_argument('--early_probe', type=bool_type, default=os.getenv('EARLY_PROBE', False), help='按字节切分的分卷先下载首尾两卷，其余分卷下载期间读取压缩包头')
+    parser.add_argument('--pipeline_upload', type=bool_type, default=os.getenv('PIPELINE_UPLOAD', False), help='压缩过程中上传已写完的分卷')
+    parser.add_argument('--stream_transcode', type=bool_type, default=os.getenv('STREAM_TRANSCODE', False), help='单文件压缩包通过管道直接重新压缩，不落地解压结果')
+    parser.add_argument('--async_jobs', type=bool_type, default=os.getenv('ASYNC_JOBS', False), help='以_async方式提交Rclone传输，由单个轮询线程统一查询任务状态')
+    parser.add_argument('--job_poll', type=float, default=float(os.getenv('JOB_POLL', 1)), help='异步任务状态轮询间隔(秒)')
+    parser.add_argument('--rc_timeout', type=float, default=float(os.getenv('RC_TIMEOUT', 0)), help='Rclone RC读取超时(秒)，为0则不限制')
     args = parser.parse_args()
     return args
 
-def main():
+def enqueue_tasks(filter_list, enqueued: set = None, only_listed: bool = False):
+    """
+    写入数据库并将其中未完成的任务投递到下载队列
+    :param filter_list: filter_files格式的分组
+    :param enqueued: 已投递过的任务名，用于跨批次、跨扫描去重
+    :param only_listed: 仅投递filter_list中的任务，否则投递数据库中全部未完成的任务
+    :return: 本次投递的任务数量
+    """
+    # 写入到sqlite3(不必担心覆盖问题)
+    database.insert_data(filter_list)
+    hold_incomplete({name: info['volumes']['problem'] for name, info in filter_list.items() if 'volumes' in info})
+    # 读取sqlite3数据,只读取未完成的数据，全部任务时按页读取，下载队列有空位时才读取下一页
+    if only_listed:
+        pages = [database.read_tasks(status=0, basenames=list(filter_list))]
+    else:
+        pages = database.page_tasks(status=0, size=feed_page)
+    count = 0
+    for tasks in pages:
+        if enqueued is not None:
+            tasks = {name: info for name, info in tasks.items() if name not in enqueued}
+        # 多个工作进程时只投递本进程领取到的任务
+        claimed = database.claim_tasks(list(tasks))
+        tasks = {name: info for name, info in tasks.items() if name in claimed}
+        if enqueued is not None:
+            enqueued.update(tasks)
+        threadstatus.add_tasks(len(tasks))  # 更新总计数器
+        # 写入到Queue，中断的任务从临时文件仍然完整的阶段继续
+        for task in tasks.items():
+            ProcessThread.handoff(task, ProcessThread.resume_queue(task))
+        count += len(tasks)
+        if not only_listed:
+            wait_feed_room()
+    return count
+
+def wait_feed_room():
+    # 下载队列中积压的任务超过一页时暂停读取数据库
+    while threadstatus.download_queue.qsize() >= feed_page:
+        time.sleep(1)
+
+def run_heartbeat():
+    # 按租约时长的三分之一定期续约，单次失败（例如数据库被其他进程锁定）不能让续约线程退出
+    while True:
+        time.sleep(lease / 3)
+        try:
+            database.renew_leases()
+        except Exception as e:
+            logging_capture.error(f"任务租约续约失败: {e}")
+
+def hold_incomplete(checks):
+    """
+    分卷不完整的任务不投递，等待下次扫描时重新检查
+    :param checks: {任务名: 分卷不完整的原因，完整则为None}
+    """
+    database.hold_incomplete(checks)
+    for name, problem in checks.items():
+        if problem:
+            logging_capture.info(f"任务{name}分卷不完整，等待补齐: {problem}")
+
+def stream_tasks(srcfs, enqueued: set):
+    """
+    流式读取源目录列表，边分组边分批写入数据库并投递下载队列
+    :param srcfs: 源目录的驱动器，例如 Alist:
+    :param enqueued: 已投递过的任务名
+    :return: 本次投递的任务数量
+    """
+    count = 0
+    files = rclone.lsjson_stream(src, args={"recurse": True, "filesOnly": True, "noMimeType": True, "noModTime": True})
+    for filter_list in fileprocess.stream_filter_files(files, srcfs, depth, batch_size=stream_batch):
+        batch_count = enqueue_tasks(filter_list, enqueued, only_listed=True)
+        count += batch_count
+        logging_capture.info(f"已读取到{batch_count}条任务，累计{count}条")
+    return count
+
+def run_scan(srcfs):
+    # 单次运行的列表线程，边读边投递，结束后通知流水线列表已读取完毕
+    try:
+        task_count = scan_once(srcfs)
+        logging_capture.info(f"已读取到{task_count}条任务")
+    except Exception as e:
+        logging_capture.error(f"读取源目录列表出错: {e}")
+    finally:
+        threadstatus.listing_done.set()
+
+def scan_incremental(srcfs):
+    """
+    增量扫描：与数据库中的列表快照比较，只对新增和变化的压缩包分组，并清理已删除的文件
+    :param srcfs: 源目录的驱动器，例如 Alist:
+    :return: 本次新增或变化的分组
+    """
+    scan = database.begin_scan()
+    delta_files = []
+    changed = set()
+
+    def snapshot(files):
+        new_paths, changed_paths = database.snapshot_files(
+            [(fileprocess.full_path(srcfs, file['Path']), file.get('Size', 0), file.get('ModTime')) for file in files],
+            scan
+        )
+        delta = set(new_paths) | set(changed_paths)
+        changed.update(changed_paths)
+        delta_files.extend(file for file in files if fileprocess.full_path(srcfs, file['Path']) in delta)
+
+    if skip_unchanged_dirs:
+        # 逐目录列出，目录修改时间未变化则跳过整个子树（需要远端支持目录修改时间）
+        dir_modtimes = {}
+
+        def dir_path(path):
+            return fileprocess.full_path(srcfs, path).rstrip('/') or '/'
+
+        def skip_dir(entry):
+            path = dir_path(entry['Path'])
+            modtime = entry.get('ModTime')
+            dir_modtimes[path] = modtime
+            if modtime and database.dir_snapshot(path)[0] == modtime:
+                database.keep_subtree(path, scan)
+                return True
+            return False
+
+        for directory, entries in rclone.walk(src, skip_dir):
+            path = dir_path(directory)
+            files = [entry for entry in entries if not entry.get('IsDir')]
+            fingerprint = hashlib.sha1(json.dumps(
+                sorted((entry['Name'], entry.get('Size', 0), entry.get('ModTime'), bool(entry.get('IsDir')))
+                       for entry in entries)
+            ).encode('utf-8')).hexdigest()
+            unchanged = database.dir_snapshot(path)[1] == fingerprint
+            if not unchanged:
+                snapshot(files)
+            database.snapshot_dir(path, dir_modtimes.get(path), fingerprint, scan, keep_files=unchanged)
+    else:
+        args = {"recurse": True, "filesOnly": True, "noMimeType": True}
+        files = rclone.lsjson_stream(src, args) if stream_listing else iter(rclone.lsjson(src, args)["list"])
+        batch = []
+        for file in files:
+            batch.append(file)
+            if len(batch) >= stream_batch:
+                snapshot(batch)
+                batch = []
+        if batch:
+            snapshot(batch)
+
+    removed = database.finish_scan(scan)
+    filter_list = fileprocess.filter_files(delta_files, srcfs, depth) if delta_files else {}
+    database.insert_data(filter_list)
+    database.refresh_tasks(
+        filter_list,
+        reset=[name for name, info in filter_list.items() if changed.intersection(info['paths'])]
+    )
+    # 变化的分组只包含本次新增的分卷，按快照中的全部分卷重新检查
+    hold_incomplete({
+        name: fileprocess.check_volumes(files)['problem']
+        for name, files in database.task_files(list(filter_list)).items()
+    })
+    # 已按全部分卷检查过，enqueue_tasks不再按增量分组检查
+    for info in filter_list.values():
+        info.pop('volumes', None)
+    logging_capture.info(f"增量扫描完成: 新增或变化{len(delta_files)}个文件，删除{len(removed)}个文件")
+    return filter_list
+
+def scan_once(srcfs, enqueued: set = None):
+    """
+    扫描一次源目录并投递未完成的任务
+    :param srcfs: 源目录的驱动器，例如 Alist:
+    :param enqueued: 已投递过的任务名
+    :return: 本次投递的任务数量
+    """
+    if incremental:
+        # 增量扫描后读取数据库中全部未完成的任务
+        return enqueue_tasks(scan_incremental(srcfs), enqueued)
+    if stream_listing:
+        return stream_tasks(srcfs, enqueued if enqueued is not None else set())
     lsjson = rclone.lsjson(src, args={"recurse": True, "filesOnly": True, "noMimeType": True, "noModTime": True})["list"]
+    # 过滤文件列表
+    filter_list = fileprocess.filter_files(lsjson,srcfs,depth) if lsjson else {}
+    return enqueue_tasks(filter_list, enqueued)
+
+def watch(srcfs):
+    """
+    监听模式：按间隔重新扫描源目录，将新出现的任务投递到运行中的流水线，不重启Rclone、数据库和线程池
+    :param srcfs: 源目录的驱动器，例如 Alist:
+    """
+    enqueued = set()
+    while True:
+        # 已结束的任务不再视为已投递，被增量扫描重置为未完成后可以再次投递
+        enqueued.intersection_update(database.read_basenames(status=0))
+        try:
+            task_count = scan_once(srcfs, enqueued)
+            logging_capture.info(f"监听扫描完成，新增{task_count}条任务")
+        except Exception as e:
+            logging_capture.error(f"监听扫描源目录出错: {e}")
+        time.sleep(watch_interval)
+
+def main():
     # todo 临时补丁,分离驱动器和名称，前者是驱动器的,例如 Alist:
     srcfs,_ = rclone.extract_parts(src)
-    # 过滤文件列表
-    filter_list = fileprocess.filter_files(lsjson,srcfs,depth)
-    # 写入到sqlite3(不必担心覆盖问题)
-    database.insert_data(filter_list)
-    # 读取sqlite3数据,只读取未完成的数据
-    tasks = database.read_data(status=0)
-    task_count = len(tasks)
-    threadstatus.add_tasks(task_count)  # 更新总计数器
-    # 写入到Queue
-    for task in tasks.items():
-        threadstatus.download_queue.put(task)
-    logging_capture.info(f"已读取到{len(tasks)}条任务")
+    if watch_interval > 0:
+        # 监听模式下列表永不结束，流水线保持运行
+        threadstatus.listing_done.clear()
+        threading.Thread(target=watch, args=(srcfs,), daemon=True).start()
+    else:
+        # 列表线程边读边投递，下载在列表结束前即可开始，任务按页读取时也依赖流水线消费腾出空位
+        threadstatus.listing_done.clear()
+        threading.Thread(target=run_scan, args=(srcfs,), daemon=True).start()
     # 启动线程
     ProcessThread.start_threads(heart)
 
@@ -605,6 +1657,26 @@ app = Flask(__name__)
 def get_throttling():
     return jsonify(threadstatus.throttling)
 
+@app.route('/controller', methods=['GET'])
+def get_controller():
+    if controller is None:
+        return jsonify({"stages": {stage: limiter.status for stage, limiter in threadstatus.limiters.items()}})
+    return jsonify(controller.status)
+
+@app.route('/stages', methods=['GET'])
+def get_stage_summary():
+    # ?since=秒 只统计最近一段时间结束的阶段
+    since = request.args.get('since', type=float)
+    return jsonify(database.stage_summary(since=time.time() - since if since else None))
+
+@app.route('/stages/<path:basename>', methods=['GET'])
+def get_stage_events(basename):
+    return jsonify(database.stage_events(basename))
+
+@app.route('/rclone', methods=['GET'])
+def get_rclone_latency():
+    return jsonify(rclone.latency)
+
 def run_flask():
     app.run(host='0.0.0.0', port=30000)
 
@@ -622,6 +1694,10 @@ if __name__ == "__main__":
     password = args.password
     mx = args.mx
     mmt = args.mmt
+    cpu_budget = args.cpu_budget
+    max_decompress = args.max_decompress
+    max_compress = args.max_compress
+    max_upload = args.max_upload
     volumes = args.volumes
     logfile = args.logfile
     depth = args.depth
@@ -630,21 +1706,70 @@ if __name__ == "__main__":
     console_log = args.console_log
     max_spaces = args.max_spaces
     interface = args.interface  # 传递网卡名称
+    rc_connect_timeout = args.rc_connect_timeout
+    rc_timeout = args.rc_timeout
+    async_jobs = args.async_jobs
+    volume_transfers = args.volume_transfers
+    max_transfers = args.max_transfers
+    filter_copy = set(args.filter_copy)
+    stream_listing = args.stream_listing
+    stream_batch = args.stream_batch
+    incremental = args.incremental
+    skip_unchanged_dirs = args.skip_unchanged_dirs
+    watch_interval = args.watch
+    schedule_max_wait = args.schedule_max_wait
+    stream_transcode = args.stream_transcode
+    pipeline_upload = args.pipeline_upload
+    early_probe = args.early_probe
+    server_passthrough = args.server_passthrough
+    adaptive = args.adaptive
+    control_interval = args.control_interval
+    upload_target = args.upload_target
+    download_target = args.download_target
+    job_poll = args.job_poll
+    feed_page = args.feed_page
+    rc_addr = args.rc_addr
+    lease = args.lease
+    worker_id = args.worker_id
 
     # 初始化实例
     logging_capture = setup_logger(logger_name='AutoRclone', log_file=logfile,console_log=console_log,level=loglevel)
-    database = DataBase(db_file)
-    rclone = OwnRclone(rclone)
-    fileprocess = FileProcess(mmt=mmt, p7zip_file=p7zip_file, autodelete=True)
+    database = DataBase(db_file, worker=(worker_id or f"{socket.gethostname()}:{os.getpid()}") if lease > 0 else None,
+                        lease=lease)
+    if lease > 0:
+        # 定期续约，进程退出后其任务在租约过期后由其他工作进程领取
+        threading.Thread(target=run_heartbeat, name="LeaseHeartbeat", daemon=True).start()
+    # 同步传输在整个传输期间占用一个连接，连接池按同时传输的上限（下载分卷、上传任务）加上列表、轮询等短调用设置
+    pool_size = max_transfers + (max_upload or psutil.cpu_count(logical=True) or 1) + max_threads + 2
+    rclone = OwnRclone(rclone, pool_size=pool_size, connect_timeout=rc_connect_timeout,
+                       read_timeout=rc_timeout if rc_timeout > 0 else None, job_poll=job_poll, link=rc_addr)
+    fileprocess = FileProcess(mmt=mmt or 1, p7zip_file=p7zip_file, autodelete=True)
     # 传递空间，若为0则不限制，否则限制空间
     # 传递空间，若为0则不限制，否则限制空间
     threadstatus = ThreadStatus(
         max_thread=max_threads,
         heart=heart,
-        max_spaces=fileprocess.get_free_size(tmp) if max_spaces == 0 else max_spaces,
-        interface=interface  # 传递网卡名称
+        max_spaces=max_spaces,
+        tmp=tmp,
+        footprint=ProcessThread.task_footprint,
+        schedule_max_wait=schedule_max_wait,
+        interface=interface,  # 传递网卡名称
+        max_transfers=max_transfers,
+        max_decompress=max_decompress,
+        max_compress=max_compress,
+        max_upload=max_upload,
+        cpu_budget=cpu_budget
     )
 
+    # 定期用实际目录大小和磁盘剩余空间校正磁盘账本
+    threading.Thread(target=threadstatus.ledger.run, args=(heart,), name="DiskLedger", daemon=True).start()
+
+    controller = None
+    if adaptive:
+        controller = ConcurrencyController(threadstatus, interval=control_interval,
+                                           upload_target=upload_target, download_target=download_target)
+        threading.Thread(target=controller.run, name="ConcurrencyController", daemon=True).start()
+
     # 启动 Flask 应用在一个单独的线程
     flask_thread = threading.Thread(target=run_flask)
     flask_thread.daemon = True
@@ -1,34 +1,197 @@
 # Rclone的调用
+import json
 import os
 import re
 import sqlite3
 import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
 from dataclasses import dataclass, field
-from typing import Dict
+from queue import Empty, Queue
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from Exception import RcloneError
 
 
+class JobPoller:
+    """
+    异步任务轮询器，所有_async提交的Rclone任务共用一个线程批量查询状态并完成对应的Future
+    """
+    def __init__(self, rclone, interval:float=1, max_errors:int=5):
+        self.rclone = rclone
+        # 轮询间隔(秒)
+        self.interval = interval
+        # 单个任务连续查询失败多少次后判定为失败
+        self.max_errors = max_errors
+        # jobid -> Future
+        self._jobs: Dict[int, Future] = {}
+        # jobid -> 连续查询失败次数
+        self._errors: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="RcloneJobPoller", daemon=True)
+        self._thread.start()
+
+    def add(self, jobid:int) -> Future:
+        future = Future()
+        # 调用方可通过future.jobid记录Rclone任务id
+        future.jobid = jobid
+        future.set_running_or_notify_cancel()
+        with self._lock:
+            self._jobs[jobid] = future
+        self._wakeup.set()
+        return future
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._jobs)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join()
+        # 未完成的任务直接报错，防止调用方一直等待
+        with self._lock:
+            jobs, self._jobs = self._jobs, {}
+        for jobid, future in jobs.items():
+            future.set_exception(RcloneError(f"Rclone任务{jobid}未完成，轮询器已停止"))
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self.pending:
+                # 没有任务时阻塞等待新任务
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                self._poll()
+            except Exception:
+                # joblist失败或返回内容无法解析时下一轮再试，轮询线程不能退出
+                pass
+            self._stop.wait(self.interval)
+
+    def _poll(self):
+        with self._lock:
+            jobids = list(self._jobs)
+        # 新版本Rclone的job/list带有runningIds，可以只查询已结束的任务
+        running = set(self.rclone.joblist().get("runningIds") or [])
+        for jobid in jobids:
+            if jobid in running:
+                continue
+            try:
+                status = self.rclone.jobstatus(jobid)
+            except RcloneError as e:
+                # Rclone重启或任务已被清理时任务不存在，直接失败；其他错误为短暂故障，下一轮重试
+                errors = self._errors.get(jobid, 0) + 1
+                if "job not found" in str(e) or errors >= self.max_errors:
+                    self._complete(jobid, error=e)
+                else:
+                    self._errors[jobid] = errors
+                continue
+            self._errors.pop(jobid, None)
+            if not status.get("finished"):
+                continue
+            if status.get("success"):
+                self._complete(jobid, result=status.get("output") or {})
+            else:
+                self._complete(jobid, error=RcloneError(f"Rclone任务{jobid}失败: {status.get('error')}"))
+
+    def _complete(self, jobid, result=None, error=None):
+        self._errors.pop(jobid, None)
+        with self._lock:
+            future = self._jobs.pop(jobid, None)
+        if future is None:
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
 class Rclone:
-    def __init__(self,rclone):
+    def __init__(self,rclone,pool_size:int=10,connect_timeout:float=5,read_timeout:Optional[float]=None,
+                 job_poll:float=1,link:str="127.0.0.1:4572"):
         # Rclone二进制文件
         self.rclone = rclone
-        # 启动参数
-        self.link = "127.0.0.1:4572"
+        # 启动参数，同一主机运行多个工作进程时需使用不同的地址
+        self.link = link
         self.args = ["rcd","--rc-no-auth",f"--rc-addr={self.link}"]
         # 是否检验文件完整性
         self.checknum = True
         # 储存Rclone进程
         self.process = None
+        # 复用连接的Session，连接池大小随线程数变化，避免每次RC调用都新建TCP连接
+        # 连接池已满时临时新建连接而不是等待，否则长时间的同步传输会阻塞job/status等短调用
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+        self.session.mount("http://", adapter)
+        # (连接超时, 读取超时)，读取超时为None则不限制（同步传输可能持续很久）
+        self.timeout = (connect_timeout, read_timeout)
+        # 每个RC接口的耗时统计
+        self._latency: Dict[str, Dict] = {}
+        self._latency_lock = threading.Lock()
+        # 异步任务轮询器，首次提交异步任务时创建
+        self.job_poll = job_poll
+        self._poller: Optional[JobPoller] = None
+        self._poller_lock = threading.Lock()
 
     def __requests(self,params,json):
-        result = requests.post(f"http://{self.link}{params}",
-                               json=json)
+        start = time.perf_counter()
+        try:
+            result = self.session.post(f"http://{self.link}{params}",
+                                       json=json, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise RcloneError(f"Rclone请求{params}失败: {e}")
+        finally:
+            self._record_latency(params, time.perf_counter() - start)
         if result.status_code != 200:
             raise RcloneError(f"Rclone异常，返回值为{result.text}")
-        return result.json()
+        try:
+            return result.json()
+        except ValueError as e:
+            raise RcloneError(f"Rclone请求{params}返回的内容无法解析: {e}")
+
+    def __submit(self, params, json) -> Future:
+        """
+        以_async方式提交任务，立即返回Future，由共享的JobPoller在任务结束时完成
+        """
+        result = self.__requests(params, dict(json, _async=True))
+        with self._poller_lock:
+            if self._poller is None:
+                self._poller = JobPoller(self, interval=self.job_poll)
+        return self._poller.add(result["jobid"])
+
+    def _call(self, params, json, _async:bool=False):
+        # _async为True时返回Future，否则同步等待返回结果
+        if _async:
+            return self.__submit(params, json)
+        return self.__requests(params, json)
+
+    def _record_latency(self, params, elapsed):
+        with self._latency_lock:
+            stat = self._latency.setdefault(params, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            stat["count"] += 1
+            stat["total_seconds"] += elapsed
+            stat["max_seconds"] = max(stat["max_seconds"], elapsed)
+
+    @property
+    def latency(self):
+        """
+        每个RC接口的调用次数和耗时
+        :return: {接口: {"count": 次数, "total_seconds": 总耗时, "max_seconds": 最大耗时, "avg_seconds": 平均耗时}}
+        """
+        with self._latency_lock:
+            return {
+                params: dict(stat, avg_seconds=stat["total_seconds"] / stat["count"] if stat["count"] else 0.0)
+                for params, stat in self._latency.items()
+            }
 
     def start_rclone(self):
         try:
@@ -48,20 +211,26 @@ class Rclone:
             raise RcloneError(f"启动应用程序失败: {e}")
 
     def stop_rclone(self):
+        if self._poller:
+            self._poller.stop()
+        self.session.close()
         if self.process:
             self.process.terminate()  # 优雅终止进程
             self.process.wait()  # 等待进程结束
 
-    def copy(self,source,dst):
+    def copy(self,source,dst,_async:bool=False,include_rules:list=None):
         json = {
             "srcFs": source,
             "dstFs": dst,
             "createEmptySrcDirs": True,
             "CheckSum": self.checknum
         }
-        return self.__requests("/sync/copy",json)
+        if include_rules:
+            # 仅复制匹配的文件，其余文件均被排除
+            json["_filter"] = {"IncludeRule": include_rules}
+        return self._call("/sync/copy",json,_async)
 
-    def copyfile(self,srcfs,srcremote,dstfs,dstremote):
+    def copyfile(self,srcfs,srcremote,dstfs,dstremote,_async:bool=False):
         json = {
             "srcFs": srcfs,
             "srcRemote": srcremote,
@@ -69,9 +238,9 @@ class Rclone:
             "dstRemote": dstremote,
             "CheckSum": self.checknum
         }
-        return self.__requests("/operations/copyfile",json)
+        return self._call("/operations/copyfile",json,_async)
 
-    def move(self,source,dst):
+    def move(self,source,dst,_async:bool=False):
         json = {
             "srcFs": source,
             "dstFs": dst,
@@ -79,9 +248,9 @@ class Rclone:
             "deleteEmptySrcDirs": True,
             "CheckSum": self.checknum
         }
-        return self.__requests("/sync/move",json)
+        return self._call("/sync/move",json,_async)
 
-    def movefile(self, srcfs, srcremote, dstfs, dstremote):
+    def movefile(self, srcfs, srcremote, dstfs, dstremote, _async:bool=False):
         json = {
             "srcFs": srcfs,
             "srcRemote": srcremote,
@@ -89,7 +258,7 @@ class Rclone:
             "dstRemote": dstremote,
             "CheckSum": self.checknum
         }
-        return self.__requests("/operations/movefile", json)
+        return self._call("/operations/movefile", json, _async)
 
     def purge(self,fs,remote):
         json = {
@@ -102,7 +271,7 @@ class Rclone:
         return self.__requests("/job/list",{})
 
     def jobstatus(self,jobid):
-        return self.__requests("/job/status",json=jobid)
+        return self.__requests("/job/status",json={"jobid": jobid})
 
     def lsjson(self,fs,remote,args:dict):
         # args 很建议为 {recurse: True,filesOnly: True,noMimeType: True,noModTime: True}
@@ -148,11 +317,96 @@ class Rclone:
 @dataclass
 class DataBase:
     db_file: str = field(init=True)
+    # 单个事务最多合并的写入命令数
+    commit_batch: int = field(default=1000)
+    # 多个工作进程共用数据库时本进程的标识，为None则不使用租约
+    worker: Optional[str] = field(default=None)
+    # 租约时长(秒)，超时未续约的任务可被其他工作进程领取
+    lease: float = field(default=300)
 
     def __post_init__(self):
-        self.database = sqlite3.connect(self.db_file)
+        # 读取共用一个连接，需加锁
+        self.database = self._connect()
         self.cursor = self.database.cursor()
+        self.lock = threading.Lock()
         self._init_database()
+        # 所有写入由单独的写线程顺序执行，同时到达的写入合并为一次提交
+        self._writes: Queue = Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="database_writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        # WAL模式下读取不会被写入阻塞，事务由写线程自行管理
+        database = sqlite3.connect(self.db_file, check_same_thread=False, timeout=30, isolation_level=None)
+        database.execute('PRAGMA journal_mode=WAL')
+        database.execute('PRAGMA synchronous=NORMAL')
+        return database
+
+    def _write_loop(self):
+        database = self._connect()
+        cursor = database.cursor()
+        running = True
+        while running:
+            command = self._writes.get()
+            if command is None:
+                break
+            batch = [command]
+            # 合并队列中已有的写入
+            while len(batch) < self.commit_batch:
+                try:
+                    command = self._writes.get_nowait()
+                except Empty:
+                    break
+                if command is None:
+                    running = False
+                    break
+                batch.append(command)
+            self._apply(cursor, batch)
+        database.close()
+
+    @staticmethod
+    def _apply(cursor: sqlite3.Cursor, batch: List[Tuple[Callable, Future]]):
+        # 一批写入在同一个事务中提交，单个写入失败只回滚它自己
+        results = []
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            for function, future in batch:
+                cursor.execute('SAVEPOINT command')
+                try:
+                    results.append((future, function(cursor), None))
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO command')
+                    results.append((future, None, e))
+                cursor.execute('RELEASE command')
+            cursor.execute('COMMIT')
+        except Exception as e:
+            if cursor.connection.in_transaction:
+                cursor.execute('ROLLBACK')
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _write(self, function: Callable[[sqlite3.Cursor], object]):
+        """
+        交给写线程执行并等待提交
+        :param function: 接收写连接游标的函数
+        :return: function的返回值
+        """
+        future = Future()
+        self._writes.put((function, future))
+        return future.result()
+
+    def close(self):
+        # 等待已提交的写入完成后关闭
+        self._writes.put(None)
+        self._writer.join()
+        with self.lock:
+            self.database.close()
 
     def _init_database(self):
         """初始化数据库和表格"""
@@ -164,10 +418,22 @@ class DataBase:
                 total_size INTEGER,
                 status INTEGER DEFAULT 0,  -- 新增状态列，默认值为0（未完成）
                 step INTEGER DEFAULT 0,    -- 新增步骤列，默认值为0（未开始）
-                log TEXT                    -- 日志列
+                log TEXT,                   -- 日志列
+                unpacked_size INTEGER,      -- 读取压缩包头得到的解压后大小
+                file_count INTEGER,         -- 读取压缩包头得到的文件数量
+                owner TEXT,                 -- 领取该任务的工作进程
+                lease_until REAL            -- 租约到期时间
             )
         ''')
 
+        # 旧版本数据库补充新增的列
+        self.cursor.execute('PRAGMA table_info(base_files)')
+        columns = {row[1] for row in self.cursor.fetchall()}
+        for column, definition in (('unpacked_size', 'INTEGER'), ('file_count', 'INTEGER'),
+                                   ('owner', 'TEXT'), ('lease_until', 'REAL')):
+            if column not in columns:
+                self.cursor.execute(f'ALTER TABLE base_files ADD COLUMN {column} {definition}')
+
         # 创建 paths 表
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS paths (
@@ -178,37 +444,120 @@ class DataBase:
             )
         ''')
 
-        self.database.commit()
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_base_files_status ON base_files (status, step)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_paths_base_file ON paths (base_file_id)')
 
-    def _insert_data(self, basename, info):
-        """插入文件的数据"""
-        # 插入或忽略基础文件信息，并初始化状态和日志
+        # 创建 password_stats 表，按目录和发布者标签统计密码命中次数
         self.cursor.execute('''
-            INSERT OR IGNORE INTO base_files (basename, total_size, status, step, log)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (basename, info['total_size'], 0, 0, ''))  # status 默认为0，step 默认为0log为空字符串
-
-        # 获取基础文件的 ID
-        self.cursor.execute('SELECT id FROM base_files WHERE basename = ?', (basename,))
-        result = self.cursor.fetchone()
-        if result:
-            base_file_id = result[0]
-        else:
-            raise ValueError(f"Failed to retrieve ID for basename: {basename}")
+            CREATE TABLE IF NOT EXISTS password_stats (
+                prefix TEXT,                -- 压缩包所在目录
+                pattern TEXT,               -- 发布者标签
+                password TEXT,
+                hits INTEGER DEFAULT 0,
+                last_hit REAL,
+                PRIMARY KEY (prefix, pattern, password)
+            )
+        ''')
 
-        # 插入路径信息
-        for path in info['paths']:
-            self.cursor.execute('''
-                INSERT OR IGNORE INTO paths (base_file_id, path)
-                VALUES (?, ?)
-            ''', (base_file_id, path))
+        # 创建 stage_events 表，记录每个任务每个阶段的排队、执行时间和处理的字节数
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stage_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                basename TEXT,
+                stage TEXT,
+                queued_at REAL,             -- 进入该阶段队列的时间
+                started_at REAL,            -- 开始执行的时间，未开始即失败则为NULL
+                ended_at REAL,
+                bytes_in INTEGER,
+                bytes_out INTEGER,
+                threads INTEGER,            -- 7z使用的线程数
+                jobid TEXT,                 -- Rclone异步任务id，多个以逗号分隔
+                success INTEGER
+            )
+        ''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_stage_events_stage ON stage_events (stage, ended_at)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_stage_events_basename ON stage_events (basename)')
+
+        # 创建 listing 表，保存上一次扫描的源目录文件快照
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS listing (
+                path TEXT PRIMARY KEY,
+                dir TEXT,                   -- 所在目录
+                size INTEGER,
+                modtime TEXT,
+                scan INTEGER                -- 最后一次出现在第几次扫描中
+            )
+        ''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_listing_dir ON listing (dir)')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_listing_scan ON listing (scan)')
+
+        # 创建 dirs 表，保存目录的修改时间和直接条目的指纹
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY,
+                modtime TEXT,
+                fingerprint TEXT,
+                scan INTEGER
+            )
+        ''')
 
         self.database.commit()
 
+    @staticmethod
+    def _chunks(items: list, size: int = 500):
+        # SQLite单条语句的参数数量有限，分批处理
+        for i in range(0, len(items), size):
+            yield items[i:i + size]
+
     def insert_data(self, filter_data: Dict[str, Dict]):
-        for basename, info in filter_data.items():
-            self._insert_data(basename, info)
-        self.database.commit()
+        """
+        插入文件的数据，已存在的基础文件和路径保持不变
+        路径已属于其他任务名的分组（旧版本depth为0时按完整文件名分组）沿用原来的任务名，filter_data中的键会被替换
+        """
+        def adopt(cursor) -> Dict[str, str]:
+            # 查询本批路径已经属于的任务
+            owners = {}
+            paths = [path for info in filter_data.values() for path in info['paths']]
+            for chunk in self._chunks(paths):
+                cursor.execute(f'''
+                    SELECT p.path, b.id, b.basename, b.status FROM paths p JOIN base_files b ON b.id = p.base_file_id
+                    WHERE p.path IN ({",".join("?" * len(chunk))})
+                ''', chunk)
+                owners.update((path, tuple(row)) for path, *row in cursor.fetchall())
+            renamed = {}
+            for basename, info in filter_data.items():
+                rows = sorted({owners[path] for path in info['paths'] if path in owners})
+                if not rows or any(row[1] == basename for row in rows):
+                    continue
+                keep_id, keep_name, keep_status = rows[0]
+                renamed[basename] = keep_name
+                if len(rows) > 1:
+                    # 旧版本每个分卷都是单独的任务，合并到id最小的任务，其余任务删除
+                    others = [row[0] for row in rows[1:]]
+                    cursor.execute(f'UPDATE paths SET base_file_id = ? WHERE base_file_id IN ({",".join("?" * len(others))})',
+                                   (keep_id, *others))
+                    cursor.execute(f'DELETE FROM base_files WHERE id IN ({",".join("?" * len(others))})', others)
+                    if keep_status != 1:
+                        # 合并后的分卷组按新任务重新处理
+                        cursor.execute('''UPDATE base_files SET total_size = ?, status = 0, step = 0, owner = NULL, log = ''
+                                          WHERE id = ?''', (info['total_size'], keep_id))
+            return renamed
+
+        def insert(cursor):
+            renamed = adopt(cursor)
+            for basename, existing in renamed.items():
+                filter_data[existing] = filter_data.pop(basename)
+            # 插入或忽略基础文件信息，status、step 默认为0，log为空字符串
+            cursor.executemany('''
+                INSERT OR IGNORE INTO base_files (basename, total_size, status, step, log)
+                VALUES (?, ?, 0, 0, '')
+            ''', [(basename, info['total_size']) for basename, info in filter_data.items()])
+            # 插入路径信息
+            cursor.executemany('''
+                INSERT OR IGNORE INTO paths (base_file_id, path)
+                VALUES ((SELECT id FROM base_files WHERE basename = ?), ?)
+            ''', [(basename, path) for basename, info in filter_data.items() for path in info['paths']])
+        self._write(insert)
 
     def update_status(self, basename: str, step: int, status: int = 0, log:str=''):
         """
@@ -217,58 +566,476 @@ class DataBase:
         参数:
             basename (str): 文件的基准名
             step(int): 执行完成的步骤 0未开始 1下载 2解压 3压缩 4上传
-            status (int): 状态码（0: 未完成, 1: 完成, 2: 密码错误, 3: 错误 4：意外错误）
+            status (int): 状态码（0: 未完成, 1: 完成, 2: 密码错误, 3: 错误 4：意外错误 5：等待分卷补齐）
             log (str): 相关日志信息
+
+        返回：
+            bool: 是否已更新，租约已被其他工作进程领取时为False
         """
-        # 单独开一个database给多线程用
-        with sqlite3.connect(self.db_file) as database:
-            cursor = database.cursor()
+        # 租约已被其他工作进程领取时不再覆盖其状态
+        def update(cursor):
             cursor.execute('''
                 UPDATE base_files
                 SET status = ?, log = ?,step = ?
-                WHERE basename = ?
-            ''', (status, log, step, basename))
-            database.commit()
+                WHERE basename = ? AND (? IS NULL OR owner IS NULL OR owner = ?)
+            ''', (status, log, step, basename, self.worker, self.worker))
+            return cursor.rowcount > 0
+        return self._write(update)
 
-    def read_data(self, status: int):
+    def claim_tasks(self, basenames: List[str]) -> set:
         """
-        从 SQLite3 数据库中读取数据，并重构为嵌套字典。
+        领取未完成的任务：未被领取、已被本进程领取或租约已过期的任务才能领取
+
+        参数:
+            basenames (List[str]): 基础文件名
 
         返回：
-            Dict[str, Dict]: 第一层键为基础文件名，值为包含 'paths' 列表和 'total_size' 的字典。
+            set: 成功领取的基础文件名，不使用租约时全部返回
         """
+        if not self.worker:
+            return set(basenames)
 
-        # 查询所有基础文件及其总大小
-        self.cursor.execute(
-            'SELECT id, basename, total_size FROM base_files WHERE status = ?',
-            (status,)
-        )
-        base_files = self.cursor.fetchall()
+        def claim(cursor):
+            now = time.time()
+            claimed = set()
+            for basename in basenames:
+                cursor.execute('''
+                    UPDATE base_files SET owner = ?, lease_until = ?
+                    WHERE basename = ? AND status = 0 AND (owner IS NULL OR owner = ? OR lease_until < ?)
+                ''', (self.worker, now + self.lease, basename, self.worker, now))
+                if cursor.rowcount:
+                    claimed.add(basename)
+            return claimed
+        return self._write(claim)
 
-        data = {}
+    def renew_leases(self):
+        # 续约本进程领取的全部未完成任务
+        if self.worker:
+            self._write(lambda cursor: cursor.execute(
+                'UPDATE base_files SET lease_until = ? WHERE owner = ? AND status = 0',
+                (time.time() + self.lease, self.worker)))
+
+    def hold_incomplete(self, checks: Dict[str, Optional[str]]):
+        """
+        分卷不完整的未开始任务置为等待分卷补齐，已补齐的等待任务恢复为未完成
+
+        参数:
+            checks (Dict[str, Optional[str]]): {基础文件名: 分卷不完整的原因，完整则为None}
+        """
+        def hold(cursor):
+            cursor.executemany('''
+                UPDATE base_files SET status = 5, log = ?
+                WHERE basename = ? AND step = 0 AND status IN (0, 5)
+            ''', [(problem, basename) for basename, problem in checks.items() if problem])
+            cursor.executemany('''
+                UPDATE base_files SET status = 0, log = '' WHERE basename = ? AND status = 5
+            ''', [(basename,) for basename, problem in checks.items() if not problem])
+        self._write(hold)
+
+    def task_files(self, basenames: List[str]) -> Dict[str, List[Tuple[str, int]]]:
+        """
+        从快照中读取任务的全部分卷及大小
+
+        参数:
+            basenames (List[str]): 基础文件名
+
+        返回：
+            Dict[str, List[Tuple[str, int]]]: {基础文件名: [(完整路径, 大小)]}，快照中没有的路径大小为0
+        """
+        files = {basename: [] for basename in basenames}
+        with self.lock:
+            for chunk in self._chunks(list(basenames)):
+                self.cursor.execute(f'''
+                    SELECT b.basename, p.path, COALESCE(l.size, 0) FROM base_files b
+                    JOIN paths p ON p.base_file_id = b.id
+                    LEFT JOIN listing l ON l.path = p.path
+                    WHERE b.basename IN ({",".join("?" * len(chunk))})
+                ''', chunk)
+                for basename, path, size in self.cursor.fetchall():
+                    files[basename].append((path, size))
+        return files
+
+    def update_probe(self, basename: str, unpacked_size: int, file_count: int):
+        """
+        记录读取压缩包头得到的解压后大小和文件数量
+
+        参数:
+            basename (str): 文件的基准名
+            unpacked_size (int): 解压后大小
+            file_count (int): 文件数量
+        """
+        self._write(lambda cursor: cursor.execute('''
+            UPDATE base_files
+            SET unpacked_size = ?, file_count = ?
+            WHERE basename = ?
+        ''', (unpacked_size, file_count, basename)))
+
+    def record_password(self, prefix: str, pattern: str, password: str):
+        """
+        记录一次密码命中
+
+        参数:
+            prefix (str): 压缩包所在目录
+            pattern (str): 发布者标签
+            password (str): 命中的密码
+        """
+        self._write(lambda cursor: cursor.execute('''
+            INSERT INTO password_stats (prefix, pattern, password, hits, last_hit) VALUES (?, ?, ?, 1, ?)
+            ON CONFLICT(prefix, pattern, password) DO UPDATE SET hits = hits + 1, last_hit = excluded.last_hit
+        ''', (prefix, pattern, password, time.time())))
+
+    def record_stage(self, basename: str, stage: str, queued_at: float, started_at: Optional[float], ended_at: float,
+                     bytes_in: int, bytes_out: int, threads: Optional[int], jobid: Optional[str], success: bool):
+        """
+        记录任务在一个阶段的耗时和吞吐
+        """
+        self._write(lambda cursor: cursor.execute('''
+            INSERT INTO stage_events (basename, stage, queued_at, started_at, ended_at, bytes_in, bytes_out,
+                                      threads, jobid, success)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (basename, stage, queued_at, started_at, ended_at, bytes_in, bytes_out, threads, jobid, int(success))))
+
+    def stage_events(self, basename: str) -> List[Dict]:
+        """
+        :param basename: 基础文件名
+        :return: 该任务的全部阶段记录，按时间排序
+        """
+        with self.lock:
+            self.cursor.execute('''
+                SELECT stage, queued_at, started_at, ended_at, bytes_in, bytes_out, threads, jobid, success
+                FROM stage_events WHERE basename = ? ORDER BY id
+            ''', (basename,))
+            columns = [column[0] for column in self.cursor.description]
+            return [dict(zip(columns, row)) for row in self.cursor.fetchall()]
+
+    @staticmethod
+    def _percentile(values: List[float], percent: float) -> Optional[float]:
+        # 最近秩法
+        if not values:
+            return None
+        values = sorted(values)
+        return values[max(int(-(-percent * len(values) // 100)) - 1, 0)]
+
+    def stage_summary(self, since: float = None) -> Dict[str, Dict]:
+        """
+        按阶段汇总成功的记录
 
-        for base_file in base_files:
-            base_id, basename, total_size = base_file
-            # 查询与该基础文件相关的所有路径
-            self.cursor.execute('SELECT path FROM paths WHERE base_file_id = ?', (base_id,))
-            paths = [row[0] for row in self.cursor.fetchall()]
+        参数:
+            since (float): 只统计该时间之后结束的记录，为None则统计全部
 
-            data[basename] = {
-                'paths': paths,
-                'total_size': total_size
+        返回：
+            Dict[str, Dict]: {阶段: {'count', 'p50_seconds', 'p95_seconds', 'p50_queued_seconds',
+                                     'p95_queued_seconds', 'mb_per_second', 'queued_share'}}
+            其中执行时间为开始到结束，排队时间为进入队列到开始，吞吐按输入字节计算
+        """
+        with self.lock:
+            self.cursor.execute('''
+                SELECT stage, queued_at, started_at, ended_at, bytes_in FROM stage_events
+                WHERE success = 1 AND started_at IS NOT NULL AND ended_at >= ?
+            ''', (since or 0,))
+            rows = self.cursor.fetchall()
+        stages = {}
+        for stage, queued_at, started_at, ended_at, bytes_in in rows:
+            record = stages.setdefault(stage, {'running': [], 'queued': [], 'bytes': 0})
+            record['running'].append(ended_at - started_at)
+            record['queued'].append(max(started_at - (queued_at if queued_at is not None else started_at), 0))
+            record['bytes'] += bytes_in or 0
+        summary = {}
+        for stage, record in stages.items():
+            running, queued = sum(record['running']), sum(record['queued'])
+            summary[stage] = {
+                'count': len(record['running']),
+                'p50_seconds': self._percentile(record['running'], 50),
+                'p95_seconds': self._percentile(record['running'], 95),
+                'p50_queued_seconds': self._percentile(record['queued'], 50),
+                'p95_queued_seconds': self._percentile(record['queued'], 95),
+                'mb_per_second': record['bytes'] / running / 1024 / 1024 if running else None,
+                'queued_share': queued / (queued + running) if queued + running else None,
             }
+        return summary
+
+    def rank_passwords(self, prefix: str, pattern: str, passwords: List[str]) -> List[str]:
+        """
+        按历史命中情况排序密码：同目录同标签 > 上级目录 > 同标签 > 全局命中次数，其余保持原顺序
+
+        参数:
+            prefix (str): 压缩包所在目录
+            pattern (str): 发布者标签
+            passwords (List[str]): 可用的密码列表
+
+        返回：
+            List[str]: 排序后的密码列表
+        """
+        if len(passwords) < 2:
+            return list(passwords)
+        with self.lock:
+            self.cursor.execute(
+                f'SELECT prefix, pattern, password, hits FROM password_stats '
+                f'WHERE password IN ({",".join("?" * len(passwords))})',
+                list(passwords)
+            )
+            rows = self.cursor.fetchall()
+        scores = {}
+        for row_prefix, row_pattern, password, hits in rows:
+            if row_prefix == prefix:
+                weight = 8 if row_pattern == pattern else 4
+            elif prefix.startswith(row_prefix.rstrip('/') + '/'):
+                weight = 3
+            elif pattern and row_pattern == pattern:
+                weight = 2
+            else:
+                weight = 1
+            scores[password] = scores.get(password, 0) + hits * weight
+        # sorted是稳定排序，没有记录的密码保持原顺序
+        return sorted(passwords, key=lambda password: -scores.get(password, 0))
+
+    def read_data(self, status: int, basenames: List[str] = None):
+        """
+        从 SQLite3 数据库中读取数据，并重构为嵌套字典。
+
+        参数:
+            status (int): 读取的状态码
+            basenames (List[str]): 仅读取这些基础文件名，为None则读取全部
+
+        返回：
+            Dict[str, Dict]: 第一层键为基础文件名，值为包含 'paths' 列表、'total_size'、'unpacked_size' 和 'file_count'（未探测则为None）
+                             以及已完成的步骤 'step' 的字典。
+        """
+        with self.lock:
+            return self._read_data(status, basenames)
+
+    def _read_data(self, status: int, basenames: List[str] = None):
+        # 一次联表查询读取基础文件及其路径，按插入顺序排列
+        query = '''
+            SELECT b.basename, b.total_size, b.unpacked_size, b.file_count, b.step, p.path FROM base_files b
+            LEFT JOIN paths p ON p.base_file_id = b.id
+            WHERE b.status = ? {}
+            ORDER BY b.id, p.id
+        '''
+        if basenames is None:
+            self.cursor.execute(query.format(''), (status,))
+            rows = self.cursor.fetchall()
+        else:
+            rows = []
+            for chunk in self._chunks(basenames):
+                self.cursor.execute(query.format(f'AND b.basename IN ({",".join("?" * len(chunk))})'),
+                                    (status, *chunk))
+                rows.extend(self.cursor.fetchall())
+
+        data = {}
+        for basename, total_size, unpacked_size, file_count, step, path in rows:
+            if basename not in data:
+                data[basename] = {
+                    'paths': [],
+                    'total_size': total_size,
+                    'unpacked_size': unpacked_size,
+                    'file_count': file_count,
+                    'step': step
+                }
+            if path is not None:
+                data[basename]['paths'].append(path)
 
-        self.database.close()
         return data
 
+    def read_tasks(self, status: int, basenames: List[str] = None, after: int = 0,
+                   limit: int = None) -> Dict[str, Dict]:
+        """
+        读取任务的精简信息，不包含路径，路径在下载开始时由read_paths读取
+
+        参数:
+            status (int): 读取的状态码
+            basenames (List[str]): 仅读取这些基础文件名，为None则按id顺序分页读取
+            after (int): 只读取id大于该值的任务
+            limit (int): 最多读取的数量，为None则不限制
+
+        返回：
+            Dict[str, Dict]: {基础文件名: {'id', 'total_size', 'unpacked_size', 'file_count', 'step'}}，按id排序
+        """
+        columns = 'id, basename, total_size, unpacked_size, file_count, step'
+        with self.lock:
+            if basenames is None:
+                self.cursor.execute(
+                    f'SELECT {columns} FROM base_files WHERE status = ? AND id > ? ORDER BY id LIMIT ?',
+                    (status, after, -1 if limit is None else limit)
+                )
+                rows = self.cursor.fetchall()
+            else:
+                rows = []
+                for chunk in self._chunks(basenames):
+                    self.cursor.execute(
+                        f'SELECT {columns} FROM base_files WHERE status = ? '
+                        f'AND basename IN ({",".join("?" * len(chunk))})',
+                        (status, *chunk)
+                    )
+                    rows.extend(self.cursor.fetchall())
+                rows.sort()
+        return {
+            basename: {'id': base_id, 'total_size': total_size, 'unpacked_size': unpacked_size,
+                       'file_count': file_count, 'step': step}
+            for base_id, basename, total_size, unpacked_size, file_count, step in rows
+        }
+
+    def page_tasks(self, status: int, size: int = 1000) -> Iterator[Dict[str, Dict]]:
+        """
+        按id顺序分页读取任务的精简信息，每次只在调用方取下一页时查询
+        :param status: 状态码
+        :param size: 每页数量
+        """
+        after = 0
+        while True:
+            page = self.read_tasks(status, after=after, limit=size)
+            if not page:
+                return
+            yield page
+            after = max(info['id'] for info in page.values())
+
+    def read_paths(self, basename: str) -> List[str]:
+        """
+        :param basename: 基础文件名
+        :return: 该任务的全部路径，按插入顺序排列
+        """
+        with self.lock:
+            self.cursor.execute('''
+                SELECT p.path FROM paths p JOIN base_files b ON b.id = p.base_file_id
+                WHERE b.basename = ? ORDER BY p.id
+            ''', (basename,))
+            return [row[0] for row in self.cursor.fetchall()]
+
+    def read_basenames(self, status: int) -> set:
+        """
+        :param status: 状态码
+        :return: 该状态下的全部基础文件名
+        """
+        with self.lock:
+            self.cursor.execute('SELECT basename FROM base_files WHERE status = ?', (status,))
+            return {row[0] for row in self.cursor.fetchall()}
+
+    def begin_scan(self) -> int:
+        """
+        开始一次增量扫描
+        :return: 本次扫描的编号
+        """
+        with self.lock:
+            self.cursor.execute('SELECT MAX(scan) FROM (SELECT scan FROM listing UNION ALL SELECT scan FROM dirs)')
+            return (self.cursor.fetchone()[0] or 0) + 1
+
+    def snapshot_files(self, files: List[Tuple[str, int, Optional[str]]], scan: int) -> Tuple[List[str], List[str]]:
+        """
+        与快照比较并更新快照
+        :param files: (完整路径, 大小, 修改时间) 列表
+        :param scan: 扫描编号
+        :return: (新增的路径, 大小或修改时间有变化的路径)
+        """
+        with self.lock:
+            known = {}
+            for chunk in self._chunks([file[0] for file in files]):
+                self.cursor.execute(
+                    f'SELECT path, size, modtime FROM listing WHERE path IN ({",".join("?" * len(chunk))})', chunk)
+                known.update((path, (size, modtime)) for path, size, modtime in self.cursor.fetchall())
+        new, changed = [], []
+        for path, size, modtime in files:
+            if path not in known:
+                new.append(path)
+            elif known[path] != (size, modtime):
+                changed.append(path)
+        self._write(lambda cursor: cursor.executemany('''
+            INSERT INTO listing (path, dir, size, modtime, scan) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET size = excluded.size, modtime = excluded.modtime, scan = excluded.scan
+        ''', [(path, OwnRclone.split_dir(path)[0], size, modtime, scan) for path, size, modtime in files]))
+        return new, changed
+
+    def dir_snapshot(self, path: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        :param path: 目录完整路径
+        :return: (上次扫描时的修改时间, 上次扫描时的指纹)
+        """
+        with self.lock:
+            self.cursor.execute('SELECT modtime, fingerprint FROM dirs WHERE path = ?', (path,))
+            return self.cursor.fetchone() or (None, None)
+
+    def snapshot_dir(self, path: str, modtime: Optional[str], fingerprint: str, scan: int, keep_files: bool = False):
+        """
+        更新目录快照
+        :param keep_files: 指纹未变化时直接保留该目录下文件的快照，不再逐个比较
+        """
+        def snapshot(cursor):
+            cursor.execute('''
+                INSERT INTO dirs (path, modtime, fingerprint, scan) VALUES (?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET modtime = excluded.modtime, fingerprint = excluded.fingerprint,
+                                                scan = excluded.scan
+            ''', (path, modtime, fingerprint, scan))
+            if keep_files:
+                cursor.execute('UPDATE listing SET scan = ? WHERE dir = ?', (scan, path))
+        self._write(snapshot)
+
+    def keep_subtree(self, path: str, scan: int):
+        # 跳过未变化的目录时，保留其整个子树的快照
+        prefix = path.rstrip('/') + '/'
+
+        def keep(cursor):
+            for table in ('listing', 'dirs'):
+                cursor.execute(f'UPDATE {table} SET scan = ? WHERE path = ? OR substr(path, 1, ?) = ?',
+                               (scan, path, len(prefix), prefix))
+        self._write(keep)
+
+    def finish_scan(self, scan: int) -> List[str]:
+        """
+        结束一次扫描，清理本次扫描中已不存在的文件，并删除失去全部分卷的未开始任务
+        只能在列表完整读取后调用，否则会误删快照
+        :return: 已被删除的路径
+        """
+        def finish(cursor):
+            cursor.execute('SELECT path FROM listing WHERE scan != ?', (scan,))
+            removed = [row[0] for row in cursor.fetchall()]
+            cursor.execute('DELETE FROM listing WHERE scan != ?', (scan,))
+            cursor.execute('DELETE FROM dirs WHERE scan != ?', (scan,))
+            cursor.executemany('DELETE FROM paths WHERE path = ?', [(path,) for path in removed])
+            cursor.execute('''
+                DELETE FROM base_files
+                WHERE status IN (0, 5) AND step = 0 AND id NOT IN (SELECT base_file_id FROM paths)
+            ''')
+            return removed
+        return self._write(finish)
+
+    def refresh_tasks(self, basenames: Iterable[str], reset: Iterable[str] = ()):
+        """
+        根据快照重新计算未完成任务的总大小，并将分卷发生变化的已处理任务重置为未开始
+        :param basenames: 需要重新计算大小的任务
+        :param reset: 需要重置的任务
+        """
+        def refresh(cursor):
+            for chunk in self._chunks(list(reset)):
+                cursor.execute(
+                    f'''UPDATE base_files SET status = 0, step = 0, owner = NULL, log = '源文件已变化，重新处理'
+                        WHERE status != 0 AND basename IN ({",".join("?" * len(chunk))})''', chunk)
+            for chunk in self._chunks(list(basenames)):
+                cursor.execute(f'''
+                    UPDATE base_files SET total_size = (
+                        SELECT COALESCE(SUM(l.size), 0) FROM paths p JOIN listing l ON l.path = p.path
+                        WHERE p.base_file_id = base_files.id
+                    )
+                    WHERE status IN (0, 5) AND basename IN ({",".join("?" * len(chunk))})
+                ''', chunk)
+        self._write(refresh)
+
 @dataclass
 class OwnRclone(Rclone):
     # 一些自用的数据库创建和优化一下官方HTTP那令人窒息的参数
     rclone:str = field(init=True)
+    # 保持的连接数，建议按同时传输的数量设置
+    pool_size:int = field(default=10)
+    connect_timeout:float = field(default=5)
+    read_timeout:Optional[float] = field(default=None)
+    # 异步任务轮询间隔(秒)
+    job_poll:float = field(default=1)
+    # RC监听地址
+    link:str = field(default="127.0.0.1:4572")
 
     def __post_init__(self):
         # 继承Rclone
-        super().__init__(self.rclone)
+        super().__init__(self.rclone, pool_size=self.pool_size,
+                         connect_timeout=self.connect_timeout, read_timeout=self.read_timeout,
+                         job_poll=self.job_poll, link=self.link)
 
     @staticmethod
     def extract_parts(s):
@@ -292,6 +1059,39 @@ class OwnRclone(Rclone):
         else:
             return None
 
+    @staticmethod
+    def split_dir(s):
+        """
+        分离完整路径中的目录和文件名
+        :param s: 完整路径，例如 Alist:a/b.rar
+        :return: (目录, 文件名)，例如 ("Alist:a", "b.rar")
+        """
+        head, sep, tail = s.rpartition('/')
+        if not sep:
+            # 位于远端根目录，例如 Alist:b.rar
+            head, sep, tail = s.rpartition(':')
+            return head + sep, tail
+        if not head or head.endswith(':'):
+            head += sep
+        return head, tail
+
+    @staticmethod
+    def escape_glob(name):
+        # 转义Rclone过滤规则中的通配符
+        return re.sub(r'([\\*?\[\]{}])', r'\\\1', name)
+
+    def copy_files(self,files:list,dst,_async:bool=False):
+        """
+        通过一次 /sync/copy 复制同一目录下的多个文件，由Rclone自身的transfers/checkers调度
+        :param files: 完整路径列表，必须位于同一目录
+        :param dst: 目标目录
+        """
+        dirs = {self.split_dir(file)[0] for file in files}
+        if len(dirs) != 1:
+            raise ValueError(f"文件不在同一目录中: {sorted(dirs)}")
+        include_rules = ["/" + self.escape_glob(self.split_dir(file)[1]) for file in files]
+        return super().copy(dirs.pop(), dst, _async=_async, include_rules=include_rules)
+
     def purge(self,s):
         # 传递完整路径即可
         fs, remote = self.extract_parts(s)
@@ -303,17 +1103,108 @@ class OwnRclone(Rclone):
         result = super().lsjson(fs,remote,args)
         return result
 
-    def movefile(self,src,dst,replace_name:str=None):
+    def walk(self,text:str,skip_dir:Callable[[Dict], bool]=None) -> Iterator[Tuple[str, List[Dict]]]:
+        """
+        逐个目录非递归地列出text下的所有条目
+        :param text: 完整路径，例如 Alist:a
+        :param skip_dir: 对子目录条目返回True时不再进入该目录
+        :return: 逐个返回 (目录相对驱动器根目录的路径, 该目录下的直接条目)
+        """
+        fs, remote = self.extract_parts(text)
+        stack = [remote]
+        while stack:
+            current = stack.pop()
+            entries = super().lsjson(fs, current, {"noMimeType": True})["list"]
+            for entry in entries:
+                if entry.get("IsDir") and not (skip_dir and skip_dir(entry)):
+                    stack.append(entry["Path"])
+            yield current, entries
+
+    # lsjson的opt参数对应的命令行参数
+    lsjson_flags = {
+        "recurse": "-R",
+        "filesOnly": "--files-only",
+        "dirsOnly": "--dirs-only",
+        "noMimeType": "--no-mimetype",
+        "noModTime": "--no-modtime",
+        "showHash": "--hash",
+    }
+
+    def lsjson_stream(self,text:str,args:dict) -> Iterator[Dict]:
+        """
+        以子进程运行 rclone lsjson 并逐条解析输出，避免一次性加载整个递归列表
+        :param text: 完整路径，例如 Alist:a
+        :param args: 与lsjson相同的opt参数
+        :return: 逐个返回文件信息字典
+        """
+        cmd = [self.rclone, "lsjson", text] + [flag for key, flag in self.lsjson_flags.items() if args.get(key)]
+        # 命令行输出的Path相对于text，补齐为与 /operations/list 一致的相对驱动器根目录的路径
+        _, remote = self.extract_parts(text)
+        prefix = remote.strip("/")
+        # 错误输出写入临时文件，防止管道写满阻塞子进程
+        stderr_file = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+        try:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file,
+                                       shell=False, text=True, encoding="utf-8")
+        except OSError as e:
+            stderr_file.close()
+            raise RcloneError(f"启动rclone lsjson失败: {e}")
+        try:
+            # rclone lsjson 每行输出一个对象，首尾为 [ 和 ]
+            for line in process.stdout:
+                line = line.strip().rstrip(",")
+                if not line or line in ("[", "]"):
+                    continue
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise RcloneError(f"无法解析rclone lsjson输出: {line}，{e}")
+                if prefix:
+                    item["Path"] = f"{prefix}/{item['Path']}"
+                yield item
+        finally:
+            if process.poll() is None:
+                process.stdout.close()
+                process.terminate()
+            returncode = process.wait()
+            stderr_file.seek(0)
+            stderr = stderr_file.read()
+            stderr_file.close()
+        if returncode != 0:
+            raise RcloneError(f"rclone lsjson异常退出({returncode}): {stderr}")
+
+    def cat(self,text:str,head:int=None,tail:int=None) -> bytes:
+        """
+        以子进程运行 rclone cat 读取远端文件开头或末尾的一部分
+        :param text: 完整路径，例如 Alist:a/b.7z
+        :param head: 读取开头的字节数
+        :param tail: 读取末尾的字节数
+        :return: 读取到的内容
+        """
+        cmd = [self.rclone, "cat", text]
+        if head:
+            cmd.extend(["--head", str(head)])
+        if tail:
+            cmd.extend(["--tail", str(tail)])
+        try:
+            result = subprocess.run(cmd, capture_output=True, shell=False)
+        except OSError as e:
+            raise RcloneError(f"启动rclone cat失败: {e}")
+        if result.returncode != 0:
+            raise RcloneError(f"rclone cat异常退出({result.returncode}): {result.stderr.decode(errors='replace')}")
+        return result.stdout
+
+    def movefile(self,src,dst,replace_name:str=None,_async:bool=False):
         srcfs, srcremote = self.extract_parts(src)
         dstfs, dstremote = self.extract_parts(dst)
         os.makedirs(dstremote,exist_ok=True)
         dstremote = os.path.join(dstremote,replace_name if replace_name else os.path.basename(srcremote)).replace("\\","/")
-        return super().movefile(srcfs,srcremote,dstfs,dstremote)
+        return super().movefile(srcfs,srcremote,dstfs,dstremote,_async)
 
-    def copyfile(self,src,dst,replace_name:str=None):
+    def copyfile(self,src,dst,replace_name:str=None,_async:bool=False):
         srcfs, srcremote = self.extract_parts(src)
         dstfs, dstremote = self.extract_parts(dst)
         os.makedirs(dstremote,exist_ok=True)
         dstremote = os.path.join(dstremote,replace_name if replace_name else os.path.basename(srcremote)).replace("\\","/")
-        return super().copyfile(srcfs,srcremote,dstfs,dstremote)
+        return super().copyfile(srcfs,srcremote,dstfs,dstremote,_async)
 